@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from typing import Iterable
+
+import cassiopeia as cass
+
+logger = logging.getLogger(__name__)
+
+_REFRESH_INTERVAL_SECONDS = 3600
+
+# Region -> (static data version, champion id -> name)
+_CHAMPION_NAMES: dict[cass.Region, tuple[str, dict[int, str]]] = {}
+
+
+def _load_champion_names(region: cass.Region) -> tuple[str, dict[int, str]]:
+    version = cass.Realms(region=region).latest_versions["champion"]
+    cached = _CHAMPION_NAMES.get(region)
+    if cached is not None and cached[0] == version:
+        return cached
+
+    logger.info(f"Loading champion names for {region.value} version {version}")
+    return version, {champ.id: champ.name for champ in cass.Champions(region=region, version=version)}
+
+
+async def refresh(regions: Iterable[cass.Region]):
+    loop = asyncio.get_running_loop()
+    for region in regions:
+        try:
+            _CHAMPION_NAMES[region] = await loop.run_in_executor(None, _load_champion_names, region)
+        except Exception as e:
+            # Callers fall back to the names stored with the matches until the next refresh
+            logger.exception(f"Could not load champion names for {region.value}:", exc_info=e)
+            _CHAMPION_NAMES.setdefault(region, ("", {}))
+
+
+async def ensure_loaded(regions: Iterable[cass.Region]):
+    await refresh(region for region in set(regions) if region not in _CHAMPION_NAMES)
+
+
+async def refresh_loop(interval_seconds: int | float = _REFRESH_INTERVAL_SECONDS):
+    while True:
+        try:
+            await asyncio.sleep(interval_seconds)
+            await refresh(list(_CHAMPION_NAMES))
+        except asyncio.CancelledError:
+            return
+
+
+def get_name(champ_id: int, region: cass.Region) -> str | None:
+    cached = _CHAMPION_NAMES.get(region)
+    if cached is None:
+        return None
+    return cached[1].get(champ_id)
@@ -1,13 +1,22 @@
+import asyncio
+import contextlib
 import hashlib
 import logging
-from typing import Any, Sequence
+from typing import Any, AsyncIterator, Iterable, Sequence
 
+import cassiopeia as cass
 import psycopg as pg
+import psycopg_pool
+from psycopg import sql
+from psycopg.types import json
 
-from app import settings
+from app import encode, metrics, settings
 
 logger = logging.getLogger(__name__)
 
+json.set_json_dumps(encode.dumps)
+json.set_json_loads(encode.loads)
+
 _CREATE_HASHED_KEY = """
 CREATE TABLE IF NOT EXISTS hashed_key (
     hashed_key  BYTEA
@@ -23,6 +32,26 @@ CREATE TABLE IF NOT EXISTS tracked_summoners (
 );
 """
 
+# Used by the updater to check active summoners more often than idle ones.
+_ADD_TRACKED_SUMMONERS_SCHEDULING_COLUMNS = (
+    """
+ALTER TABLE tracked_summoners
+ADD COLUMN IF NOT EXISTS matches_per_day DOUBLE PRECISION NOT NULL DEFAULT 0;
+""",
+    """
+ALTER TABLE tracked_summoners
+ADD COLUMN IF NOT EXISTS idle_checks INT NOT NULL DEFAULT 0;
+""",
+    """
+ALTER TABLE tracked_summoners
+ADD COLUMN IF NOT EXISTS last_checked_at TIMESTAMPTZ;
+""",
+    """
+ALTER TABLE tracked_summoners
+ADD COLUMN IF NOT EXISTS next_check_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+""",
+)
+
 _CREATE_TRACKED_SUMMONERS_INDICES = (
     """
 CREATE UNIQUE INDEX IF NOT EXISTS idx_tracked_summoners_account_data_puuid ON tracked_summoners (
@@ -35,6 +64,11 @@ CREATE UNIQUE INDEX IF NOT EXISTS idx_tracked_summoners_summoner_data_puuid ON t
     (summoner_data -> 'puuid')
 )
 NULLS NOT DISTINCT;
+""",
+    """
+CREATE INDEX IF NOT EXISTS idx_tracked_summoners_next_check_at ON tracked_summoners (
+    next_check_at
+);
 """,
 )
 
@@ -45,6 +79,30 @@ CREATE TABLE IF NOT EXISTS matches (
 );
 """
 
+# Typed copies of the match_data fields which MatchFilters filters on, so that they can be indexed.
+_ADD_MATCHES_GENERATED_COLUMNS = (
+    """
+ALTER TABLE matches
+ADD COLUMN IF NOT EXISTS queue INT GENERATED ALWAYS AS ((match_data -> 'queue')::int) STORED;
+""",
+    """
+ALTER TABLE matches
+ADD COLUMN IF NOT EXISTS platform TEXT GENERATED ALWAYS AS (match_data ->> 'platform') STORED;
+""",
+    """
+ALTER TABLE matches
+ADD COLUMN IF NOT EXISTS continent TEXT GENERATED ALWAYS AS (match_data ->> 'continent') STORED;
+""",
+    """
+ALTER TABLE matches
+ADD COLUMN IF NOT EXISTS match_id TEXT GENERATED ALWAYS AS (match_data ->> 'id') STORED;
+""",
+    """
+ALTER TABLE matches
+ADD COLUMN IF NOT EXISTS start_time TIMESTAMPTZ GENERATED ALWAYS AS (TO_TIMESTAMP((match_data -> 'start')::float8)) STORED;
+""",
+)
+
 _CREATE_MATCHES_INDICES = (
     """
 CREATE UNIQUE INDEX IF NOT EXISTS idx_matches_uniqueness ON matches (
@@ -55,9 +113,397 @@ CREATE UNIQUE INDEX IF NOT EXISTS idx_matches_uniqueness ON matches (
     (match_data -> 'id')
 )
 NULLS NOT DISTINCT;
+""",
+    """
+CREATE INDEX IF NOT EXISTS idx_matches_platform_match_id ON matches (
+    platform,
+    match_id
+);
+""",
+    """
+CREATE INDEX IF NOT EXISTS idx_matches_queue_start_time ON matches (
+    queue,
+    start_time
+);
+""",
+    """
+CREATE INDEX IF NOT EXISTS idx_matches_platform_start_time ON matches (
+    platform,
+    start_time
+);
+""",
+    """
+CREATE INDEX IF NOT EXISTS idx_matches_start_time_brin ON matches
+USING BRIN (start_time);
 """,
 )
 
+# One row per participant of each match, so analytics don't have to unnest match_data.
+_CREATE_MATCH_PARTICIPANTS = """
+CREATE TABLE IF NOT EXISTS match_participants (
+    match_id                BIGINT NOT NULL REFERENCES matches (id) ON DELETE CASCADE,
+    participant_index       INT NOT NULL,
+    puuid                   TEXT,
+    champion_id             INT NOT NULL,
+    champion_name           TEXT,
+    win                     BOOLEAN NOT NULL,
+    side                    INT,
+    is_bot                  BOOLEAN,
+    queue                   INT,
+    platform                TEXT,
+    start_time              TIMESTAMPTZ,
+    kills                   INT,
+    deaths                  INT,
+    assists                 INT,
+    champion_damage         BIGINT,
+    gold_earned             INT,
+    PRIMARY KEY (match_id, participant_index)
+);
+"""
+
+_CREATE_MATCH_PARTICIPANTS_INDICES = (
+    """
+CREATE INDEX IF NOT EXISTS idx_match_participants_champion_id ON match_participants (
+    champion_id
+)
+INCLUDE (win);
+""",
+    """
+CREATE INDEX IF NOT EXISTS idx_match_participants_puuid_champion_id ON match_participants (
+    puuid,
+    champion_id
+)
+INCLUDE (win);
+""",
+    """
+CREATE INDEX IF NOT EXISTS idx_match_participants_puuid_champion_id_damage ON match_participants (
+    puuid,
+    champion_id,
+    champion_damage DESC NULLS LAST
+);
+""",
+    """
+CREATE INDEX IF NOT EXISTS idx_match_participants_queue_start_time ON match_participants (
+    queue,
+    start_time
+);
+""",
+    """
+CREATE INDEX IF NOT EXISTS idx_match_participants_start_time_brin ON match_participants
+USING BRIN (start_time);
+""",
+)
+
+_INSERT_MATCH_PARTICIPANTS = sql.SQL(
+    """
+INSERT INTO match_participants (
+    match_id,
+    participant_index,
+    puuid,
+    champion_id,
+    champion_name,
+    win,
+    side,
+    is_bot,
+    queue,
+    platform,
+    start_time,
+    kills,
+    deaths,
+    assists,
+    champion_damage,
+    gold_earned
+)
+SELECT
+    matches.id,
+    p.idx,
+    p.participant->>'puuid',
+    (p.participant->'championId')::int,
+    p.participant->>'championName',
+    (p.participant->'stats'->'win')::bool,
+    (p.participant->'side')::int,
+    (p.participant->'isBot')::bool,
+    matches.queue,
+    matches.platform,
+    matches.start_time,
+    (p.participant->'stats'->'kills')::int,
+    (p.participant->'stats'->'deaths')::int,
+    (p.participant->'stats'->'assists')::int,
+    (p.participant->'stats'->'totalDamageDealtToChampions')::bigint,
+    (p.participant->'stats'->'goldEarned')::int
+FROM matches
+CROSS JOIN LATERAL JSONB_ARRAY_ELEMENTS(matches.match_data->'participants') WITH ORDINALITY AS p(participant, idx)
+WHERE {match_filter}
+ON CONFLICT DO NOTHING;
+"""
+)
+
+# Games and wins per champion and UTC day, so that win rates over long date ranges don't have to aggregate every
+# participant.
+_CREATE_CHAMPION_WIN_RATE_ROLLUP = """
+CREATE TABLE IF NOT EXISTS champion_win_rate_rollup (
+    champion_id             INT NOT NULL,
+    queue                   INT,
+    platform                TEXT,
+    day                     DATE,
+    champion_name           TEXT,
+    wins                    BIGINT NOT NULL,
+    games                   BIGINT NOT NULL
+);
+"""
+
+_CREATE_CHAMPION_WIN_RATE_ROLLUP_INDICES = (
+    """
+CREATE UNIQUE INDEX IF NOT EXISTS idx_champion_win_rate_rollup_uniqueness ON champion_win_rate_rollup (
+    champion_id,
+    queue,
+    platform,
+    day
+)
+NULLS NOT DISTINCT;
+""",
+    """
+CREATE INDEX IF NOT EXISTS idx_champion_win_rate_rollup_queue_day ON champion_win_rate_rollup (
+    queue,
+    day
+);
+""",
+)
+
+_INCREMENT_CHAMPION_WIN_RATE_ROLLUP = sql.SQL(
+    """
+INSERT INTO champion_win_rate_rollup (champion_id, queue, platform, day, champion_name, wins, games)
+SELECT
+    match_participants.champion_id,
+    match_participants.queue,
+    match_participants.platform,
+    (match_participants.start_time AT TIME ZONE 'UTC')::date,
+    ANY_VALUE(match_participants.champion_name),
+    SUM(match_participants.win::int),
+    COUNT(*)
+FROM match_participants
+JOIN matches ON matches.id = match_participants.match_id
+WHERE {match_filter}
+GROUP BY 1, 2, 3, 4
+ON CONFLICT (champion_id, queue, platform, day) DO UPDATE SET
+    wins = champion_win_rate_rollup.wins + EXCLUDED.wins,
+    games = champion_win_rate_rollup.games + EXCLUDED.games;
+"""
+)
+
+# Games and wins of each champion against each champion on the other team per UTC day, so that the full matchup
+# matrix doesn't have to pair up the participants of every match.
+_CREATE_CHAMPION_MATCHUPS = """
+CREATE TABLE IF NOT EXISTS champion_matchups (
+    champ_as                INT NOT NULL,
+    champ_against           INT NOT NULL,
+    queue                   INT,
+    platform                TEXT,
+    day                     DATE,
+    champ_as_name           TEXT,
+    champ_against_name      TEXT,
+    wins                    BIGINT NOT NULL,
+    games                   BIGINT NOT NULL
+);
+"""
+
+_CREATE_CHAMPION_MATCHUPS_INDICES = (
+    """
+CREATE UNIQUE INDEX IF NOT EXISTS idx_champion_matchups_uniqueness ON champion_matchups (
+    champ_as,
+    champ_against,
+    queue,
+    platform,
+    day
+)
+NULLS NOT DISTINCT;
+""",
+    """
+CREATE INDEX IF NOT EXISTS idx_champion_matchups_queue_day ON champion_matchups (
+    queue,
+    day
+);
+""",
+)
+
+_INCREMENT_CHAMPION_MATCHUPS = sql.SQL(
+    """
+INSERT INTO champion_matchups (
+    champ_as,
+    champ_against,
+    queue,
+    platform,
+    day,
+    champ_as_name,
+    champ_against_name,
+    wins,
+    games
+)
+SELECT
+    match_participants.champion_id,
+    against.champion_id,
+    match_participants.queue,
+    match_participants.platform,
+    (match_participants.start_time AT TIME ZONE 'UTC')::date,
+    ANY_VALUE(match_participants.champion_name),
+    ANY_VALUE(against.champion_name),
+    SUM(match_participants.win::int),
+    COUNT(*)
+FROM match_participants
+JOIN match_participants AS against
+    ON against.match_id = match_participants.match_id AND against.side <> match_participants.side
+JOIN matches ON matches.id = match_participants.match_id
+WHERE {match_filter}
+GROUP BY 1, 2, 3, 4, 5
+ON CONFLICT (champ_as, champ_against, queue, platform, day) DO UPDATE SET
+    wins = champion_matchups.wins + EXCLUDED.wins,
+    games = champion_matchups.games + EXCLUDED.games;
+"""
+)
+
+# Undo the rollup increments of matches which are about to be deleted. Rows are matched on champion first so that the
+# unique index can be used despite the nullable columns.
+_DECREMENT_CHAMPION_WIN_RATE_ROLLUP = sql.SQL(
+    """
+WITH removed AS (
+    SELECT
+        match_participants.champion_id,
+        match_participants.queue,
+        match_participants.platform,
+        (match_participants.start_time AT TIME ZONE 'UTC')::date AS day,
+        SUM(match_participants.win::int) AS wins,
+        COUNT(*) AS games
+    FROM match_participants
+    JOIN matches ON matches.id = match_participants.match_id
+    WHERE {match_filter}
+    GROUP BY 1, 2, 3, 4
+)
+UPDATE champion_win_rate_rollup
+SET
+    wins = champion_win_rate_rollup.wins - removed.wins,
+    games = champion_win_rate_rollup.games - removed.games
+FROM removed
+WHERE champion_win_rate_rollup.champion_id = removed.champion_id
+    AND champion_win_rate_rollup.queue IS NOT DISTINCT FROM removed.queue
+    AND champion_win_rate_rollup.platform IS NOT DISTINCT FROM removed.platform
+    AND champion_win_rate_rollup.day IS NOT DISTINCT FROM removed.day;
+"""
+)
+
+_DECREMENT_CHAMPION_MATCHUPS = sql.SQL(
+    """
+WITH removed AS (
+    SELECT
+        match_participants.champion_id AS champ_as,
+        against.champion_id AS champ_against,
+        match_participants.queue,
+        match_participants.platform,
+        (match_participants.start_time AT TIME ZONE 'UTC')::date AS day,
+        SUM(match_participants.win::int) AS wins,
+        COUNT(*) AS games
+    FROM match_participants
+    JOIN match_participants AS against
+        ON against.match_id = match_participants.match_id AND against.side <> match_participants.side
+    JOIN matches ON matches.id = match_participants.match_id
+    WHERE {match_filter}
+    GROUP BY 1, 2, 3, 4, 5
+)
+UPDATE champion_matchups
+SET
+    wins = champion_matchups.wins - removed.wins,
+    games = champion_matchups.games - removed.games
+FROM removed
+WHERE champion_matchups.champ_as = removed.champ_as
+    AND champion_matchups.champ_against = removed.champ_against
+    AND champion_matchups.queue IS NOT DISTINCT FROM removed.queue
+    AND champion_matchups.platform IS NOT DISTINCT FROM removed.platform
+    AND champion_matchups.day IS NOT DISTINCT FROM removed.day;
+"""
+)
+
+# Tables derived from match_data which have to be kept in sync whenever matches are inserted. Order matters since
+# rollups are computed from match_participants.
+_POPULATE_DERIVED_TABLES = (
+    _INSERT_MATCH_PARTICIPANTS,
+    _INCREMENT_CHAMPION_WIN_RATE_ROLLUP,
+    _INCREMENT_CHAMPION_MATCHUPS,
+)
+
+# Rollups which are rebuilt from match_participants if they were added after participants were already stored.
+_REBUILDABLE_ROLLUPS = (
+    ("champion_win_rate_rollup", _INCREMENT_CHAMPION_WIN_RATE_ROLLUP),
+    ("champion_matchups", _INCREMENT_CHAMPION_MATCHUPS),
+)
+
+# Rollups which aren't cleaned up by cascading deletes of matches, with the queries that take matches back out of them
+_DECREMENTABLE_ROLLUPS = (
+    ("champion_win_rate_rollup", _DECREMENT_CHAMPION_WIN_RATE_ROLLUP),
+    ("champion_matchups", _DECREMENT_CHAMPION_MATCHUPS),
+)
+
+_NEW_MATCHES_FILTER = sql.SQL("matches.id = ANY(%(match_ids)s)")
+
+
+# Bumped whenever matches are inserted so that results computed from them can be cached until then.
+_CREATE_MATCHES_GENERATION = """
+CREATE TABLE IF NOT EXISTS matches_generation (
+    singleton               BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+    generation              BIGINT NOT NULL DEFAULT 0
+);
+"""
+
+# The updater's API budget left to schedule checks with. It refills at the configured budget per interval however many
+# workers take turns scheduling.
+_CREATE_UPDATER_BUDGET = """
+CREATE TABLE IF NOT EXISTS updater_budget (
+    singleton               BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+    available               DOUBLE PRECISION NOT NULL DEFAULT 0,
+    refilled_at             TIMESTAMPTZ
+);
+"""
+
+# Summoners waiting to be checked by an ingest worker. Workers lease jobs so that a job held by a worker which died is
+# picked up again once its lease expires.
+_CREATE_INGEST_JOBS = """
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    summoner_id             BIGINT PRIMARY KEY REFERENCES tracked_summoners (id) ON DELETE CASCADE,
+    due_at                  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    attempts                INT NOT NULL DEFAULT 0,
+    lease_expires_at        TIMESTAMPTZ
+);
+"""
+
+_CREATE_INGEST_JOBS_INDICES = (
+    """
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_due_at ON ingest_jobs (
+    due_at
+);
+""",
+)
+
+_BUMP_MATCHES_GENERATION = "UPDATE matches_generation SET generation = generation + 1"
+
+# Matches are COPY'd into this session-local table in bulk before being merged into the matches table.
+_CREATE_STAGED_MATCHES = """
+CREATE TEMPORARY TABLE IF NOT EXISTS staged_matches (
+    match_data              JSONB NOT NULL
+)
+ON COMMIT DELETE ROWS;
+"""
+
+_COPY_STAGED_MATCHES = "COPY staged_matches (match_data) FROM STDIN"
+
+_INSERT_STAGED_MATCHES = """
+INSERT INTO matches (match_data)
+SELECT match_data FROM staged_matches
+ON CONFLICT DO NOTHING
+RETURNING id, platform, match_id;
+"""
+
+_DEFAULT_WRITER_BATCH_SIZE = 500
+
+_pool: psycopg_pool.AsyncConnectionPool | None = None
+
 
 class InvalidRiotApiKeyError(Exception):
     pass
@@ -70,16 +516,215 @@ class MissingRiotApiKeyError(Exception):
 def init():
     logger.info("Initializing DB")
     with connect() as conn:
-        for query in (_CREATE_HASHED_KEY, _CREATE_TRACKED_SUMMONERS, _CREATE_MATCHES):
+        for query in (
+            _CREATE_HASHED_KEY,
+            _CREATE_TRACKED_SUMMONERS,
+            _CREATE_MATCHES,
+            _CREATE_MATCH_PARTICIPANTS,
+            _CREATE_CHAMPION_WIN_RATE_ROLLUP,
+            _CREATE_CHAMPION_MATCHUPS,
+            _CREATE_MATCHES_GENERATION,
+            _CREATE_UPDATER_BUDGET,
+            _CREATE_INGEST_JOBS,
+        ):
+            conn.execute(query)
+        conn.execute("INSERT INTO matches_generation DEFAULT VALUES ON CONFLICT DO NOTHING")
+        conn.execute("INSERT INTO updater_budget DEFAULT VALUES ON CONFLICT DO NOTHING")
+        for query in _ADD_MATCHES_GENERATED_COLUMNS:
+            conn.execute(query)
+        for query in _ADD_TRACKED_SUMMONERS_SCHEDULING_COLUMNS:
             conn.execute(query)
         for query in _CREATE_TRACKED_SUMMONERS_INDICES:
             conn.execute(query)
         for query in _CREATE_MATCHES_INDICES:
             conn.execute(query)
+        for query in _CREATE_MATCH_PARTICIPANTS_INDICES:
+            conn.execute(query)
+        for query in _CREATE_CHAMPION_WIN_RATE_ROLLUP_INDICES:
+            conn.execute(query)
+        for query in _CREATE_CHAMPION_MATCHUPS_INDICES:
+            conn.execute(query)
+        for query in _CREATE_INGEST_JOBS_INDICES:
+            conn.execute(query)
+
+        backfill_derived_tables(conn)
 
     insert_riot_api_key()
 
 
+def backfill_derived_tables(conn: pg.Connection):
+    with conn.transaction():
+        # Workers starting together would otherwise each see the same empty tables and count every match twice. The
+        # second waits here and then finds nothing left to do.
+        conn.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", ("backfill_derived_tables",))
+        has_participants = conn.execute("SELECT EXISTS (SELECT 1 FROM match_participants) AS e").fetchone()["e"]
+        for table, query in _REBUILDABLE_ROLLUPS:
+            is_empty = not conn.execute(
+                sql.SQL("SELECT EXISTS (SELECT 1 FROM {0}) AS e").format(sql.Identifier(table))
+            ).fetchone()["e"]
+            if has_participants and is_empty:
+                logger.info(f"Rebuilding {table}")
+                conn.execute(query.format(match_filter=sql.SQL("TRUE")))
+
+        match_ids = [
+            row["id"]
+            for row in conn.execute(
+                """
+                    SELECT id
+                    FROM matches
+                    WHERE NOT EXISTS (SELECT 1 FROM match_participants WHERE match_participants.match_id = matches.id);
+                """
+            )
+        ]
+        if match_ids:
+            logger.info(f"Backfilling derived tables for {len(match_ids)} matches")
+            populate_derived_tables(conn, match_ids)
+
+
+def populate_derived_tables(conn: pg.Connection, match_ids: Sequence[int]):
+    for query in _POPULATE_DERIVED_TABLES:
+        conn.execute(query.format(match_filter=_NEW_MATCHES_FILTER), {"match_ids": list(match_ids)})
+
+
+def delete_matches(conn: pg.Connection, match_ids: Sequence[int]) -> int:
+    # Deletes the matches along with everything derived from them, returning how many were deleted
+    with conn.transaction():
+        for table, query in _DECREMENTABLE_ROLLUPS:
+            conn.execute(query.format(match_filter=_NEW_MATCHES_FILTER), {"match_ids": list(match_ids)})
+            conn.execute(sql.SQL("DELETE FROM {0} WHERE games <= 0").format(sql.Identifier(table)))
+        deleted = conn.execute("DELETE FROM matches WHERE id = ANY(%s)", (list(match_ids),)).rowcount
+        if deleted:
+            conn.execute(_BUMP_MATCHES_GENERATION)
+    return deleted
+
+
+async def async_populate_derived_tables(conn: pg.AsyncConnection, match_ids: Sequence[int]):
+    for query in _POPULATE_DERIVED_TABLES:
+        await conn.execute(query.format(match_filter=_NEW_MATCHES_FILTER), {"match_ids": list(match_ids)})
+
+
+async def find_stored_matches(conn: pg.AsyncConnection, keys: Iterable[tuple[str, str]]) -> set[tuple[str, str]]:
+    keys = list(keys)
+    if not keys:
+        return set()
+
+    cursor = await conn.execute(
+        """
+            SELECT platform, match_id
+            FROM matches
+            WHERE (platform, match_id) IN (SELECT * FROM UNNEST(%s::text[], %s::text[]));
+        """,
+        ([platform for platform, _ in keys], [match_id for _, match_id in keys]),
+    )
+    return {(row["platform"], row["match_id"]) async for row in cursor}
+
+
+class _BaseMatchWriter:
+    def __init__(self, batch_size: int, track_keys: bool):
+        self.batch_size = batch_size
+        self.track_keys = track_keys
+        self.inserted = 0
+        self.skipped = 0
+        # (platform, match_id) of every inserted match, only if track_keys is set
+        self.inserted_keys: set[tuple[str, str]] = set()
+        self._buffer: list[dict[str, Any]] = []
+
+    def _take_batch(self) -> list[dict[str, Any]]:
+        batch, self._buffer = self._buffer, []
+        return batch
+
+    def _record(self, batch: list[dict[str, Any]], inserted_rows: list[dict[str, Any]]):
+        self.inserted += len(inserted_rows)
+        self.skipped += len(batch) - len(inserted_rows)
+        if self.track_keys:
+            self.inserted_keys.update((row["platform"], row["match_id"]) for row in inserted_rows)
+
+
+class MatchWriter(_BaseMatchWriter):
+    def __init__(self, conn: pg.Connection, batch_size: int = _DEFAULT_WRITER_BATCH_SIZE, track_keys: bool = False):
+        super().__init__(batch_size, track_keys)
+        self.conn = conn
+
+    def __enter__(self) -> "MatchWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, match_data: dict[str, Any]):
+        self._buffer.append(match_data)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        batch = self._take_batch()
+        if not batch:
+            return
+
+        with metrics.MATCH_WRITER_FLUSH_SECONDS.time(), self.conn.transaction():
+            self.conn.execute(_CREATE_STAGED_MATCHES)
+            with self.conn.cursor() as cursor, cursor.copy(_COPY_STAGED_MATCHES) as copy:
+                for match_data in batch:
+                    copy.write_row((json.Jsonb(match_data),))
+            inserted_rows = self.conn.execute(_INSERT_STAGED_MATCHES).fetchall()
+            if inserted_rows:
+                populate_derived_tables(self.conn, [row["id"] for row in inserted_rows])
+                self.conn.execute(_BUMP_MATCHES_GENERATION)
+        self._record(batch, inserted_rows)
+
+
+class AsyncMatchWriter(_BaseMatchWriter):
+    def __init__(
+        self, conn: pg.AsyncConnection, batch_size: int = _DEFAULT_WRITER_BATCH_SIZE, track_keys: bool = False
+    ):
+        super().__init__(batch_size, track_keys)
+        self.conn = conn
+        # Matches may be added from concurrent tasks but the connection can only run one transaction at a time.
+        self._flush_lock = asyncio.Lock()
+
+    async def __aenter__(self) -> "AsyncMatchWriter":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.flush()
+
+    async def add(self, match_data: dict[str, Any]):
+        self._buffer.append(match_data)
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            batch = self._take_batch()
+            if not batch:
+                return
+
+            with metrics.MATCH_WRITER_FLUSH_SECONDS.time():
+                async with self.conn.transaction():
+                    await self.conn.execute(_CREATE_STAGED_MATCHES)
+                    async with self.conn.cursor() as cursor, cursor.copy(_COPY_STAGED_MATCHES) as copy:
+                        for match_data in batch:
+                            await copy.write_row((json.Jsonb(match_data),))
+                    inserted_rows = await (await self.conn.execute(_INSERT_STAGED_MATCHES)).fetchall()
+                    if inserted_rows:
+                        await async_populate_derived_tables(self.conn, [row["id"] for row in inserted_rows])
+                        await self.conn.execute(_BUMP_MATCHES_GENERATION)
+            self._record(batch, inserted_rows)
+
+
+async def matches_generation(conn: pg.AsyncConnection) -> int:
+    cursor = await conn.execute("SELECT generation FROM matches_generation")
+    return (await cursor.fetchone())["generation"]
+
+
+async def tracked_regions() -> set[cass.Region]:
+    async with async_pooled_connection() as conn:
+        cursor = await conn.execute("SELECT DISTINCT summoner_data ->> 'region' AS region FROM tracked_summoners")
+        return {cass.Region(row["region"]) async for row in cursor}
+
+
 def validate_riot_api_key() -> True:
     expected_row = {"hashed_key": hashlib.sha256(settings.riot_api_key().encode()).digest()}
     with connect() as conn:
@@ -115,11 +760,75 @@ def connect(autocommit: bool = True) -> pg.Connection:
     return pg.Connection.connect(**settings.sql_conn_settings(), autocommit=autocommit, row_factory=DictRowFactory)
 
 
+@contextlib.asynccontextmanager
+async def try_advisory_lock(name: str) -> AsyncIterator[pg.AsyncConnection | None]:
+    # Yields the connection holding the lock, or None if another session holds it. The lock is session level so it
+    # lives on a dedicated connection rather than a pooled one, and is released by closing that connection.
+    async with await async_connect() as conn:
+        # Have the server notice a vanished holder within about half a minute rather than the OS default of hours
+        await conn.execute("SET tcp_keepalives_idle = 10")
+        await conn.execute("SET tcp_keepalives_interval = 5")
+        await conn.execute("SET tcp_keepalives_count = 3")
+        cursor = await conn.execute("SELECT pg_try_advisory_lock(hashtext(%s)) AS acquired", (name,))
+        yield conn if (await cursor.fetchone())["acquired"] else None
+
+
 async def async_connect(autocommit: bool = True) -> pg.AsyncConnection:
     return await pg.AsyncConnection.connect(
         **settings.sql_conn_settings(), autocommit=autocommit, row_factory=DictRowFactory
     )
 
 
+async def open_pool():
+    global _pool
+    if _pool is not None:
+        return
+
+    logger.info("Opening DB connection pool")
+    _pool = psycopg_pool.AsyncConnectionPool(
+        kwargs=settings.sql_conn_settings() | {"autocommit": True, "row_factory": DictRowFactory},
+        open=False,
+        name="app",
+        **settings.sql_pool_settings(),
+    )
+    await _pool.open(wait=True)
+
+
+async def close_pool():
+    global _pool
+    if _pool is None:
+        return
+
+    logger.info("Closing DB connection pool")
+    await _pool.close()
+    _pool = None
+
+
+@contextlib.asynccontextmanager
+async def async_pooled_connection() -> AsyncIterator[pg.AsyncConnection]:
+    # Falls back to a dedicated connection when there is no pool, e.g. when running a module as a script.
+    if _pool is None:
+        async with await async_connect() as conn:
+            yield conn
+        return
+
+    async with _pool.connection() as conn:
+        yield conn
+
+
+async def get_async_connection() -> AsyncIterator[pg.AsyncConnection]:
+    async with async_pooled_connection() as conn:
+        yield conn
+
+
+def pool_stats() -> dict[str, int]:
+    if _pool is None:
+        return {}
+    return _pool.get_stats()
+
+
+metrics.register_pool_stats(pool_stats)
+
+
 if __name__ == "__main__":
     init()
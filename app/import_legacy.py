@@ -1,19 +1,106 @@
+import argparse
+import collections
+import concurrent.futures
+import dataclasses
 import datetime
 import enum
 import logging
+import os
 import re
+import time
 from typing import Any
 
+import bson
 import cassiopeia as cass
+import psycopg as pg
 import pymongo
 from bson import int64
-from psycopg import errors
-from psycopg.types import json
 
 from app import db, settings
 
 logger = logging.getLogger(__name__)
 
+_CREATE_LEGACY_IMPORT_PARTITIONS = """
+CREATE TABLE IF NOT EXISTS legacy_import_partitions (
+    id                      INT PRIMARY KEY,
+    lower_id                TEXT,
+    upper_id                TEXT,
+    last_id                 TEXT,
+    done                    BOOLEAN NOT NULL DEFAULT FALSE
+);
+"""
+
+_SELECT_LEGACY_IMPORT_PARTITIONS = (
+    "SELECT id, lower_id, upper_id, last_id, done FROM legacy_import_partitions ORDER BY id"
+)
+
+# Types of the fields of every match, participant and participant stats seen in the matches table so far. Matches
+# are only profiled once, up to match_schema_profile_state.profiled_through.
+_CREATE_MATCH_SCHEMA_PROFILE = """
+CREATE TABLE IF NOT EXISTS match_schema_profile (
+    scope                   TEXT NOT NULL,
+    field                   TEXT NOT NULL,
+    json_type               TEXT NOT NULL,
+    count                   BIGINT NOT NULL,
+    PRIMARY KEY (scope, field, json_type)
+);
+"""
+
+_CREATE_MATCH_SCHEMA_PROFILE_STATE = """
+CREATE TABLE IF NOT EXISTS match_schema_profile_state (
+    singleton               BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+    profiled_through        BIGINT NOT NULL DEFAULT 0
+);
+"""
+
+_UPDATE_MATCH_SCHEMA_PROFILE = """
+WITH new_matches AS (
+    SELECT match_data
+    FROM matches
+    WHERE id > %(profiled_through)s AND id <= %(profile_until)s
+), participants AS (
+    SELECT JSONB_ARRAY_ELEMENTS(match_data -> 'participants') AS participant
+    FROM new_matches
+), fields AS (
+    SELECT 'match' AS scope, field.key, field.value
+    FROM new_matches, JSONB_EACH(match_data) AS field
+    UNION ALL
+    SELECT 'participant' AS scope, field.key, field.value
+    FROM participants, JSONB_EACH(participant) AS field
+    UNION ALL
+    SELECT 'stats' AS scope, field.key, field.value
+    FROM participants, JSONB_EACH(participant -> 'stats') AS field
+)
+INSERT INTO match_schema_profile (scope, field, json_type, count)
+SELECT
+    scope,
+    key,
+    CASE
+        -- JSON doesn't distinguish ints from floats but Python does
+        WHEN JSONB_TYPEOF(value) = 'number' AND value::text ~ '^-?[0-9]+$' THEN 'integer'
+        WHEN JSONB_TYPEOF(value) = 'number' THEN 'float'
+        ELSE JSONB_TYPEOF(value)
+    END AS json_type,
+    COUNT(*)
+FROM fields
+GROUP BY 1, 2, 3
+ON CONFLICT (scope, field, json_type) DO UPDATE SET count = match_schema_profile.count + EXCLUDED.count;
+"""
+
+_JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "float": float,
+    "boolean": bool,
+    "null": type(None),
+}
+
+_PARTITIONS_PER_WORKER = 4
+
+_CHECKPOINT_INTERVAL = 1000
+
 EXPECTED_MATCH_FIELD_TYPES = {}
 EXPECTED_PARTICIPANT_FIELD_TYPES = {}
 EXPECTED_STATS_FIELD_TYPES = {}
@@ -129,10 +216,6 @@ OK_MISSING_STATS_FIELDS = {
 }
 
 
-class DuplicateLegacyMatchError(Exception):
-    pass
-
-
 class GarbageInputError(Exception):
     pass
 
@@ -358,60 +441,216 @@ def fix_stats(s: dict[str, Any]):
             raise IncorrectTypeAfterFixingError(f"stats[{key}] is type {type(s[key])}")
 
 
+def _delete_all_bot_matches(conn: pg.Connection):
+    with conn.transaction():
+        match_ids = [
+            row["match_id"]
+            for row in conn.execute(
+                """
+                    SELECT match_id
+                    FROM match_participants
+                    GROUP BY match_id
+                    HAVING BOOL_AND(is_bot);
+                """
+            )
+        ]
+        deleted = db.delete_matches(conn, match_ids) if match_ids else 0
+    if deleted > 0:
+        logger.warning(f"Deleted {deleted} matches since they have all bots")
+
+
+def _update_schema_profile(conn: pg.Connection):
+    with conn.transaction():
+        conn.execute(_CREATE_MATCH_SCHEMA_PROFILE)
+        conn.execute(_CREATE_MATCH_SCHEMA_PROFILE_STATE)
+        conn.execute("INSERT INTO match_schema_profile_state DEFAULT VALUES ON CONFLICT DO NOTHING")
+
+        state = conn.execute("SELECT profiled_through FROM match_schema_profile_state FOR UPDATE").fetchone()
+        profile_until = conn.execute("SELECT COALESCE(MAX(id), 0) AS id FROM matches").fetchone()["id"]
+        if profile_until <= state["profiled_through"]:
+            return
+
+        logger.info(f"Profiling match fields for matches {state["profiled_through"] + 1} to {profile_until}")
+        conn.execute(
+            _UPDATE_MATCH_SCHEMA_PROFILE,
+            {"profiled_through": state["profiled_through"], "profile_until": profile_until},
+        )
+        conn.execute("UPDATE match_schema_profile_state SET profiled_through = %s", (profile_until,))
+
+
 def determine_expected_field_types():
     with db.connect() as conn:
-        for row in conn.execute("SELECT id, match_data as m FROM matches"):
-            current_m = row["m"]
-            for field in current_m:
-                EXPECTED_MATCH_FIELD_TYPES[field] = type(current_m[field])
-            if all(p["isBot"] for p in current_m["participants"]):
-                logger.warning(f"Deleting match {row["id"]} since it has all bots")
-                conn.execute("DELETE FROM matches WHERE id = %s", (row["id"],))
-            for participant in current_m["participants"]:
-                for field in participant:
-                    EXPECTED_PARTICIPANT_FIELD_TYPES[field] = type(participant[field])
-                for field in participant["stats"]:
-                    EXPECTED_STATS_FIELD_TYPES[field] = type(participant["stats"][field])
-
-
-def import_legacy():
-    determine_expected_field_types()
+        _delete_all_bot_matches(conn)
+        _update_schema_profile(conn)
 
+        expected_field_types = {
+            "match": EXPECTED_MATCH_FIELD_TYPES,
+            "participant": EXPECTED_PARTICIPANT_FIELD_TYPES,
+            "stats": EXPECTED_STATS_FIELD_TYPES,
+        }
+        # Rows are ordered so that the most commonly observed type of each field is applied last
+        for row in conn.execute("SELECT scope, field, json_type FROM match_schema_profile ORDER BY count"):
+            expected_field_types[row["scope"]][row["field"]] = _JSON_TYPES[row["json_type"]]
+
+
+@dataclasses.dataclass
+class ImportStats:
+    processed: int = 0
+    inserted: int = 0
+    duplicates: int = 0
+    rejected: collections.Counter[str] = dataclasses.field(default_factory=collections.Counter)
+
+    def merge(self, other: "ImportStats"):
+        self.processed += other.processed
+        self.inserted += other.inserted
+        self.duplicates += other.duplicates
+        self.rejected += other.rejected
+
+
+def _plan_partitions(partition_count: int) -> list[tuple[str | None, str | None]]:
     client = pymongo.MongoClient()
-    with client.start_session() as session, db.connect() as conn:
-        match_cursor = client.lol.matches.find(no_cursor_timeout=True, session=session).batch_size(100)
-        matches_processed = 0
-        dupes_found = 0
-        seen_ids = set()
+    buckets = client.lol.matches.aggregate(
+        [{"$bucketAuto": {"groupBy": "$_id", "buckets": partition_count}}], allowDiskUse=True
+    )
+    lower_ids = [str(bucket["_id"]["min"]) for bucket in buckets]
+    if not lower_ids:
+        return []
+
+    # Leave the outer partitions unbounded so nothing is missed if the collection changed since planning
+    lower_ids[0] = None
+    return list(zip(lower_ids, lower_ids[1:] + [None]))
+
+
+def _load_partitions(workers: int, restart: bool) -> list[dict[str, Any]]:
+    with db.connect() as conn:
+        conn.execute(_CREATE_LEGACY_IMPORT_PARTITIONS)
+        if restart:
+            conn.execute("DELETE FROM legacy_import_partitions")
+
+        partitions = conn.execute(_SELECT_LEGACY_IMPORT_PARTITIONS).fetchall()
+        if partitions:
+            return partitions
+
+        for id, (lower_id, upper_id) in enumerate(_plan_partitions(workers * _PARTITIONS_PER_WORKER)):
+            conn.execute(
+                "INSERT INTO legacy_import_partitions (id, lower_id, upper_id) VALUES (%s, %s, %s)",
+                (id, lower_id, upper_id),
+            )
+        return conn.execute(_SELECT_LEGACY_IMPORT_PARTITIONS).fetchall()
+
+
+def _init_worker(
+    match_field_types: dict[str, type], participant_field_types: dict[str, type], stats_field_types: dict[str, type]
+):
+    settings.apply_global_settings()
+    EXPECTED_MATCH_FIELD_TYPES.update(match_field_types)
+    EXPECTED_PARTICIPANT_FIELD_TYPES.update(participant_field_types)
+    EXPECTED_STATS_FIELD_TYPES.update(stats_field_types)
+
+
+def _save_checkpoint(
+    conn: pg.Connection, writer: db.MatchWriter, partition_id: int, last_id: bson.ObjectId | None, done: bool = False
+):
+    # Everything up to last_id has to be committed before the checkpoint moves past it
+    writer.flush()
+    conn.execute(
+        "UPDATE legacy_import_partitions SET last_id = COALESCE(%s, last_id), done = %s WHERE id = %s",
+        (str(last_id) if last_id is not None else None, done, partition_id),
+    )
+
+
+def _import_partition(partition: dict[str, Any]) -> ImportStats:
+    id_range = {}
+    if partition["last_id"] is not None:
+        id_range["$gt"] = bson.ObjectId(partition["last_id"])
+    elif partition["lower_id"] is not None:
+        id_range["$gte"] = bson.ObjectId(partition["lower_id"])
+    if partition["upper_id"] is not None:
+        id_range["$lt"] = bson.ObjectId(partition["upper_id"])
+
+    stats = ImportStats()
+    client = pymongo.MongoClient()
+    with (
+        client.start_session() as session,
+        db.connect() as conn,
+        db.MatchWriter(conn, batch_size=_CHECKPOINT_INTERVAL) as writer,
+    ):
+        match_cursor = (
+            client.lol.matches.find({"_id": id_range} if id_range else {}, no_cursor_timeout=True, session=session)
+            .sort("_id", pymongo.ASCENDING)
+            .batch_size(_CHECKPOINT_INTERVAL)
+        )
+
+        last_id = None
         for match_data in match_cursor:
+            last_id = match_data["_id"]
+            stats.processed += 1
             try:
                 fix_match(match_data)
-                if match_data["id"] in seen_ids:
-                    raise DuplicateLegacyMatchError(f"Match {match_data["id"]} seen multiple times")
-                conn.execute(
-                    "INSERT INTO matches(match_data) VALUES (%s)",
-                    (json.Jsonb(match_data),),
-                )
-                seen_ids.add(match_data["id"])
-                matches_processed += 1
-                if matches_processed % 100 == 0:
-                    logger.info(f"Processed {matches_processed} matches so far...")
-            except errors.UniqueViolation:
-                dupes_found += 1
-                logger.debug(f"Tried to insert duplicate {match_data["id"]}")
-                continue
+                writer.add(match_data)
             except GarbageInputError as e:
                 # Don't import garbage data
-                logger.error(e)
-                continue
-            except DuplicateLegacyMatchError as e:
-                logger.error(e)
-                continue
+                logger.debug(f"Rejected {last_id}: {e}")
+                stats.rejected[str(e)] += 1
 
-        logger.info(f"Processed {matches_processed} matches total")
-        logger.info(f"Ignored {dupes_found} existing matches")
+            if stats.processed % _CHECKPOINT_INTERVAL == 0:
+                _save_checkpoint(conn, writer, partition["id"], last_id)
+                logger.info(f"Partition {partition["id"]} processed {stats.processed} matches so far...")
+
+        _save_checkpoint(conn, writer, partition["id"], last_id, done=True)
+
+    stats.inserted = writer.inserted
+    stats.duplicates = writer.skipped
+    return stats
+
+
+def _rate(count: int, elapsed: float) -> float:
+    return count / elapsed if elapsed > 0 else 0.0
+
+
+def import_legacy(workers: int | None = None, restart: bool = False):
+    determine_expected_field_types()
+
+    workers = workers or os.cpu_count() or 1
+    partitions = _load_partitions(workers, restart)
+    pending = [partition for partition in partitions if not partition["done"]]
+    logger.info(f"Importing {len(pending)} of {len(partitions)} partitions with {workers} workers")
+
+    total = ImportStats()
+    start_time = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(EXPECTED_MATCH_FIELD_TYPES, EXPECTED_PARTICIPANT_FIELD_TYPES, EXPECTED_STATS_FIELD_TYPES),
+    ) as executor:
+        futures = {executor.submit(_import_partition, partition): partition for partition in pending}
+        for future in concurrent.futures.as_completed(futures):
+            total.merge(future.result())
+            elapsed = time.monotonic() - start_time
+            logger.info(
+                f"Finished partition {futures[future]["id"]}, {total.processed} matches processed so far "
+                f"({_rate(total.processed, elapsed):.1f} matches/sec)"
+            )
+
+    elapsed = time.monotonic() - start_time
+    logger.info(
+        f"Processed {total.processed} matches total in {elapsed:.1f}s "
+        f"({_rate(total.processed, elapsed):.1f} matches/sec)"
+    )
+    logger.info(f"Inserted {total.inserted} new matches")
+    logger.info(f"Ignored {total.duplicates} existing matches")
+    logger.info(f"Rejected {total.rejected.total()} matches")
+    for reason, count in total.rejected.most_common():
+        logger.info(f"    {count}: {reason}")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import matches from the legacy Mongo DB")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument(
+        "--restart", action="store_true", help="discard checkpoints from a previous import and start from scratch"
+    )
+    args = parser.parse_args()
+
     settings.apply_global_settings()
-    import_legacy()
+    import_legacy(workers=args.workers, restart=args.restart)
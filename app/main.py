@@ -7,8 +7,8 @@ import fastapi
 import uvicorn
 from fastapi import responses
 
-from app import db, notifiarr, settings
-from app.routers import champ_win_rates, summoner, update_matches
+from app import champions, db, notifiarr, riot_api, settings
+from app.routers import champ_stats, champ_win_rates, live, matchups, monitoring, summoner, update_matches
 
 logger = logging.getLogger(__name__)
 
@@ -23,10 +23,19 @@ async def lifespan(_: fastapi.FastAPI):
     logging.config.dictConfig(settings.get_dict()["logging"])
     db.init()
     settings.apply_global_settings()
+    await db.open_pool()
+    await champions.refresh(await db.tracked_regions() | {settings.default_region()})
+    await live.refresh_matchups()
 
     update_matches_task = asyncio.create_task(update_matches.update_matches_loop())
+    ingest_task = asyncio.create_task(update_matches.ingest_loop())
+    champion_names_task = asyncio.create_task(champions.refresh_loop())
     yield
+    champion_names_task.cancel()
+    ingest_task.cancel()
     update_matches_task.cancel()
+    await riot_api.close_client()
+    await db.close_pool()
 
 
 app = fastapi.FastAPI(lifespan=lifespan)
@@ -34,6 +43,10 @@ app = fastapi.FastAPI(lifespan=lifespan)
 app.include_router(summoner.router)
 app.include_router(update_matches.router)
 app.include_router(champ_win_rates.router)
+app.include_router(champ_stats.router)
+app.include_router(matchups.router)
+app.include_router(live.router)
+app.include_router(monitoring.router)
 
 
 @app.middleware("http")
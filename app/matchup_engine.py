@@ -0,0 +1,207 @@
+import argparse
+import collections
+import dataclasses
+import time
+
+import numpy as np
+import psycopg as pg
+from psycopg import rows, sql
+
+from app import model
+
+_LOAD_PARTICIPANTS_QUERY = sql.SQL(
+    """
+SELECT match_id, side, champion_id, win::int
+FROM match_participants
+WHERE {filter_expr}
+    AND side IS NOT NULL
+    AND {played_expr}
+ORDER BY match_id;
+"""
+)
+
+# Matches are paired up this many at a time so the pair arrays of a large history don't have to fit in memory at once
+_MATCHES_PER_CHUNK = 65536
+
+# Restricts the participants to matches which one of the given accounts played in
+_PLAYED_FILTER = sql.SQL(
+    "match_id IN (SELECT played.match_id FROM match_participants AS played WHERE played.puuid = ANY(%(puuid_list)s))"
+)
+
+
+@dataclasses.dataclass
+class Participants:
+    # One element per participant, grouped by match
+    match_id: np.ndarray
+    side: np.ndarray
+    champion_id: np.ndarray
+    win: np.ndarray
+
+
+@dataclasses.dataclass
+class MatchupMatrices:
+    # Entry [i, j] counts the games champion_ids[i] played against (or with) champion_ids[j], and how many it won
+    champion_ids: np.ndarray
+    against_wins: np.ndarray
+    against_games: np.ndarray
+    with_wins: np.ndarray
+    with_games: np.ndarray
+
+    def index(self, champion_id: int) -> int | None:
+        i = int(np.searchsorted(self.champion_ids, champion_id))
+        if i == len(self.champion_ids) or self.champion_ids[i] != champion_id:
+            return None
+        return i
+
+
+async def load_participants(
+    conn: pg.AsyncConnection, match_filters: model.MatchFilters, puuids: list[str] | None = None
+) -> Participants:
+    async with conn.cursor(row_factory=rows.tuple_row) as cursor:
+        await cursor.execute(
+            _LOAD_PARTICIPANTS_QUERY.format(
+                filter_expr=match_filters.sql_filter_expression("match_participants"),
+                played_expr=_PLAYED_FILTER if puuids is not None else sql.SQL("TRUE"),
+            ),
+            match_filters.sql_filter_params() | {"puuid_list": puuids},
+        )
+        columns = np.array(await cursor.fetchall(), dtype=np.int64).reshape(-1, 4).T
+    return Participants(match_id=columns[0], side=columns[1], champion_id=columns[2], win=columns[3].astype(bool))
+
+
+def compute(participants: Participants) -> MatchupMatrices:
+    # Champion ids are small, so they're mapped to matrix indices with a lookup table rather than by sorting
+    is_present = np.bincount(participants.champion_id) > 0
+    lookup = np.cumsum(is_present) - 1
+    champion_ids = np.flatnonzero(is_present)
+    num_champions = len(champion_ids)
+
+    # Lay the participants out as a (match, position) grid, padded with -1 for matches with fewer participants
+    match_id = participants.match_id
+    order = None
+    if np.any(match_id[1:] < match_id[:-1]):
+        order = np.argsort(match_id, kind="stable")
+        match_id = match_id[order]
+    is_first = np.empty(len(match_id), dtype=bool)
+    is_first[:1] = True
+    is_first[1:] = match_id[1:] != match_id[:-1]
+    match_number = np.cumsum(is_first) - 1
+    first_positions = np.flatnonzero(is_first)
+    position = np.arange(len(match_id)) - first_positions[match_number]
+    num_matches = len(first_positions)
+    width = int(position.max()) + 1 if len(position) else 0
+
+    def grid(values: np.ndarray, fill: int) -> np.ndarray:
+        result = np.full((num_matches, width), fill, dtype=np.int32)
+        result[match_number, position] = values if order is None else values[order]
+        return result
+
+    champions = grid(lookup[participants.champion_id], -1)
+    sides = grid(participants.side, 0)
+    wins = grid(participants.win, 0)
+
+    # Each ordered pair of participants is counted in one of four matrices, laid out one after another: against and
+    # lost, against and won, with and lost, with and won. Pairs that aren't counted go in a trailing overflow cell.
+    num_cells = num_champions * num_champions
+    counts = np.zeros(4 * num_cells + 1, dtype=np.int64)
+    is_self = np.eye(width, dtype=bool)
+    for start in range(0, num_matches, _MATCHES_PER_CHUNK):
+        chunk = slice(start, start + _MATCHES_PER_CHUNK)
+        champ_as = champions[chunk, :, None]
+        champ_other = champions[chunk, None, :]
+        same_side = sides[chunk, :, None] == sides[chunk, None, :]
+        matrix = 2 * same_side + wins[chunk, :, None]
+        cells = matrix * num_cells + champ_as * num_champions + champ_other
+        cells[(champ_as < 0) | (champ_other < 0) | is_self] = 4 * num_cells
+        counts += np.bincount(cells.ravel(), minlength=len(counts))
+
+    against_lost, against_won, with_lost, with_won = counts[:-1].reshape(4, num_champions, num_champions)
+    return MatchupMatrices(
+        champion_ids=champion_ids,
+        against_wins=against_won,
+        against_games=against_lost + against_won,
+        with_wins=with_won,
+        with_games=with_lost + with_won,
+    )
+
+
+def _synthetic_participants(num_matches: int, num_champions: int, seed: int = 0) -> Participants:
+    rng = np.random.default_rng(seed)
+    # Champions are unique within a match, like in draft games
+    champion_id = np.argsort(rng.random((num_matches, num_champions)), axis=1)[:, :10] + 1
+    blue_won = rng.random(num_matches) < 0.5
+    side = np.tile(np.repeat([100, 200], 5), num_matches)
+    return Participants(
+        match_id=np.repeat(np.arange(num_matches), 10),
+        side=side,
+        champion_id=champion_id.ravel(),
+        win=np.repeat(blue_won, 10) == (side == 100),
+    )
+
+
+def _legacy_matchups(participants: Participants) -> dict[int, dict[int, dict[str, int]]]:
+    # The per-pair loop of the legacy full_matchups_table, over participants grouped into matches like its Mongo
+    # aggregate returns them
+    matches = collections.defaultdict(list)
+    for match_id, side, champion_id, win in zip(
+        participants.match_id.tolist(),
+        participants.side.tolist(),
+        participants.champion_id.tolist(),
+        participants.win.tolist(),
+    ):
+        matches[match_id].append({"side": side, "championId": champion_id, "stats": {"win": win}})
+
+    counts = collections.defaultdict(lambda: collections.defaultdict(lambda: collections.defaultdict(int)))
+    for match_participants in matches.values():
+        for participant_as in match_participants:
+            for participant_against in match_participants:
+                if participant_as["side"] == participant_against["side"]:
+                    continue
+                stats = counts[participant_as["championId"]][participant_against["championId"]]
+                stats["games_played"] += 1
+                stats["wins"] += participant_as["stats"]["win"]
+    return counts
+
+
+def _benchmark(num_matches: int, num_legacy_matches: int, num_champions: int):
+    participants = _synthetic_participants(num_matches, num_champions)
+
+    start_time = time.perf_counter()
+    matrices = compute(participants)
+    seconds = time.perf_counter() - start_time
+    print(f"compute: {seconds:.2f} s for {num_matches} matches ({seconds / num_matches * 1e6:.2f} us/match)")
+
+    # The legacy loop is too slow to run over the whole dataset, so it's timed on a prefix
+    num_legacy_matches = min(num_legacy_matches, num_matches)
+    legacy_participants = Participants(
+        **{
+            field.name: getattr(participants, field.name)[: num_legacy_matches * 10]
+            for field in dataclasses.fields(Participants)
+        }
+    )
+    start_time = time.perf_counter()
+    counts = _legacy_matchups(legacy_participants)
+    seconds = time.perf_counter() - start_time
+    print(
+        f"legacy full_matchups_table loop: {seconds:.2f} s for {num_legacy_matches} matches "
+        f"({seconds / num_legacy_matches * 1e6:.2f} us/match)"
+    )
+
+    legacy_matrices = compute(legacy_participants)
+    for champ_as, row in counts.items():
+        for champ_against, stats in row.items():
+            i, j = legacy_matrices.index(champ_as), legacy_matrices.index(champ_against)
+            assert legacy_matrices.against_games[i, j] == stats["games_played"]
+            assert legacy_matrices.against_wins[i, j] == stats["wins"]
+    assert legacy_matrices.against_games.sum() == num_legacy_matches * 50
+    assert matrices.against_games.sum() == num_matches * 50
+    assert matrices.with_games.sum() == num_matches * 40
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare computing matchups with NumPy and with the legacy loop.")
+    parser.add_argument("-n", "--matches", type=int, default=1_000_000)
+    parser.add_argument("--legacy-matches", type=int, default=20_000)
+    parser.add_argument("--champions", type=int, default=170)
+    args = parser.parse_args()
+    _benchmark(args.matches, args.legacy_matches, args.champions)
@@ -0,0 +1,135 @@
+from typing import Any, Callable, Iterator
+
+import prometheus_client
+from prometheus_client import core, registry
+
+from app import lru_cache
+
+_ROW_COUNT_BUCKETS = (0, 1, 10, 50, 100, 250, 500, 1000, 5000, 10000)
+
+UPDATER_STAGE_SECONDS = prometheus_client.Histogram(
+    "leaguestats_updater_stage_seconds",
+    "Time spent in each stage of the updater",
+    ["stage"],
+)
+
+INGEST_BATCH_SECONDS = prometheus_client.Histogram(
+    "leaguestats_ingest_batch_seconds",
+    "Time taken to check a batch of queued summoners",
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+
+INGEST_JOBS = prometheus_client.Counter(
+    "leaguestats_ingest_jobs_total",
+    "Queued summoner checks by outcome",
+    ["outcome"],
+)
+
+MATCHES_STORED = prometheus_client.Counter("leaguestats_matches_stored_total", "Matches stored by the updater")
+
+MATCHES_SKIPPED_DUPLICATES = prometheus_client.Counter(
+    "leaguestats_matches_skipped_duplicates_total",
+    "Matches the updater loaded which were already stored",
+)
+
+MATCH_LOADS_SAVED = prometheus_client.Counter(
+    "leaguestats_match_loads_saved_total",
+    "Match API calls avoided because the match was shared or already stored",
+)
+
+RIOT_API_REQUEST_SECONDS = prometheus_client.Histogram(
+    "leaguestats_riot_api_request_seconds",
+    "Riot API request latency",
+    ["method", "status"],
+)
+
+RIOT_API_RATE_LIMIT_WAIT_SECONDS = prometheus_client.Histogram(
+    "leaguestats_riot_api_rate_limit_wait_seconds",
+    "Time Riot API requests waited on the client's rate limiters",
+    ["method"],
+    buckets=(0, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120),
+)
+
+RIOT_API_RETRIES = prometheus_client.Counter(
+    "leaguestats_riot_api_retries_total",
+    "Riot API requests retried after an error",
+    ["method", "reason"],
+)
+
+MATCH_WRITER_FLUSH_SECONDS = prometheus_client.Histogram(
+    "leaguestats_match_writer_flush_seconds",
+    "Time taken to insert a batch of matches and their derived rows",
+)
+
+QUERY_SECONDS = prometheus_client.Histogram(
+    "leaguestats_query_seconds",
+    "Latency of the SQL behind query endpoints",
+    ["query"],
+)
+
+QUERY_ROWS = prometheus_client.Histogram(
+    "leaguestats_query_rows",
+    "Rows returned by the SQL behind query endpoints",
+    ["query"],
+    buckets=_ROW_COUNT_BUCKETS,
+)
+
+
+class _CacheCollector(registry.Collector):
+    def __init__(self):
+        self.caches: dict[str, lru_cache.LruCache] = {}
+
+    def collect(self) -> Iterator[core.Metric]:
+        hits = core.CounterMetricFamily(
+            "leaguestats_cache_hits", "Cache lookups which found an entry", labels=["cache"]
+        )
+        misses = core.CounterMetricFamily("leaguestats_cache_misses", "Cache lookups which missed", labels=["cache"])
+        entries = core.GaugeMetricFamily("leaguestats_cache_entries", "Entries in the cache", labels=["cache"])
+        for name, cache in self.caches.items():
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+            entries.add_metric([name], len(cache))
+        yield from (hits, misses, entries)
+
+
+class _PoolCollector(registry.Collector):
+    def __init__(self):
+        self.stats: Callable[[], dict[str, Any]] | None = None
+
+    def collect(self) -> Iterator[core.Metric]:
+        stats = self.stats() if self.stats is not None else {}
+        if not stats:
+            return
+
+        yield core.GaugeMetricFamily("leaguestats_db_pool_size", "Connections in the pool", value=stats["pool_size"])
+        yield core.GaugeMetricFamily(
+            "leaguestats_db_pool_in_use",
+            "Connections checked out of the pool",
+            value=stats["pool_size"] - stats["pool_available"],
+        )
+        yield core.GaugeMetricFamily(
+            "leaguestats_db_pool_waiting", "Requests waiting for a connection", value=stats["requests_waiting"]
+        )
+        yield core.CounterMetricFamily(
+            "leaguestats_db_pool_requests", "Connections requested from the pool", value=stats.get("requests_num", 0)
+        )
+        yield core.CounterMetricFamily(
+            "leaguestats_db_pool_wait_seconds",
+            "Time spent waiting for a connection from the pool",
+            value=stats.get("requests_wait_ms", 0) / 1000,
+        )
+
+
+_CACHES = _CacheCollector()
+prometheus_client.REGISTRY.register(_CACHES)
+
+_POOL = _PoolCollector()
+prometheus_client.REGISTRY.register(_POOL)
+
+
+def register_cache(name: str, cache: lru_cache.LruCache):
+    _CACHES.caches[name] = cache
+
+
+def register_pool_stats(stats: Callable[[], dict[str, Any]]):
+    _POOL.stats = stats
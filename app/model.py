@@ -35,30 +35,52 @@ class MatchFilters(pydantic.BaseModel):
     after: datetime.datetime | None = None
     before: datetime.datetime | None = None
 
-    def sql_filter_expression(self, src_table: str = "matches"):
+    @pydantic.field_validator("after", "before")
+    @classmethod
+    def _assume_utc(cls, value: datetime.datetime | None) -> datetime.datetime | None:
+        # Naive times would otherwise be interpreted in the DB session's time zone
+        if value is not None and value.tzinfo is None:
+            return value.replace(tzinfo=datetime.UTC)
+        return value
+
+    def whole_days(self) -> tuple[datetime.date | None, datetime.date | None]:
+        # Returns the [first, end) range of UTC days which are entirely within the filter's time range
+        first_day = None
+        if self.after is not None:
+            after = self.after.astimezone(datetime.UTC)
+            first_day = after.date()
+            if after.time() != datetime.time.min:
+                first_day += datetime.timedelta(days=1)
+
+        end_day = None
+        if self.before is not None:
+            end_day = self.before.astimezone(datetime.UTC).date()
+
+        return first_day, end_day
+
+    # `param_prefix` namespaces the placeholders so that several filters can be used in one query
+    def sql_filter_expression(self, src_table: str = "matches", param_prefix: str = "MatchFilters"):
         conjunctions = []
         if self.region is not None:
             conjunctions.append(
-                sql.SQL("{0}.match_data -> 'platformId' = {1}").format(
-                    sql.Identifier(src_table), sql.Placeholder("MatchFilters.region")
+                sql.SQL("{0}.platform = {1}").format(
+                    sql.Identifier(src_table), sql.Placeholder(f"{param_prefix}.region")
                 )
             )
         if self.queue is not None:
             conjunctions.append(
-                sql.SQL("{0}.match_data -> 'queue' = {1}").format(
-                    sql.Identifier(src_table), sql.Placeholder("MatchFilters.queue")
-                )
+                sql.SQL("{0}.queue = {1}").format(sql.Identifier(src_table), sql.Placeholder(f"{param_prefix}.queue"))
             )
         if self.after is not None:
             conjunctions.append(
-                sql.SQL("{0}.match_data -> 'start' >= {1}").format(
-                    sql.Identifier(src_table), sql.Placeholder("MatchFilters.after")
+                sql.SQL("{0}.start_time >= {1}").format(
+                    sql.Identifier(src_table), sql.Placeholder(f"{param_prefix}.after")
                 )
             )
         if self.before is not None:
             conjunctions.append(
-                sql.SQL("{0}.match_data -> 'start' <= {1}").format(
-                    sql.Identifier(src_table), sql.Placeholder("MatchFilters.before")
+                sql.SQL("{0}.start_time <= {1}").format(
+                    sql.Identifier(src_table), sql.Placeholder(f"{param_prefix}.before")
                 )
             )
         if not conjunctions:
@@ -66,10 +88,16 @@ class MatchFilters(pydantic.BaseModel):
 
         return sql.SQL(" AND ").join(conjunctions)
 
-    def sql_filter_params(self) -> dict[str, Any]:
+    def sql_filter_params(self, param_prefix: str = "MatchFilters") -> dict[str, Any]:
         return {
-            "MatchFilters.region": cass.Platform.from_region(self.region).value if self.region is not None else None,
-            "MatchFilters.queue": self.queue.id if self.queue is not None else None,
-            "MatchFilters.after": self.after,
-            "MatchFilters.before": self.before,
+            f"{param_prefix}.region": cass.Platform.from_region(self.region).value if self.region is not None else None,
+            f"{param_prefix}.queue": self.queue.id if self.queue is not None else None,
+            f"{param_prefix}.after": self.after,
+            f"{param_prefix}.before": self.before,
         }
+
+
+def day_start(day: datetime.date | None) -> datetime.datetime | None:
+    if day is None:
+        return None
+    return datetime.datetime.combine(day, datetime.time.min, tzinfo=datetime.UTC)
@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import dataclasses
+import datetime
+import logging
+import time
+from typing import Any
+
+import cassiopeia as cass
+import httpx
+from cassiopeia.core import account as cass_account
+from cassiopeia.core import match as cass_match
+from cassiopeia.core import summoner as cass_summoner
+
+from app import metrics, settings
+
+logger = logging.getLogger(__name__)
+
+# The most match ids Riot returns per request
+MATCH_IDS_PAGE_SIZE = 100
+
+_REQUEST_TIMEOUT_SECONDS = 10.0
+
+_DEFAULT_RETRY_AFTER_SECONDS = 1.0
+
+_client: "RiotApiClient | None" = None
+
+
+class RiotApiError(Exception):
+    pass
+
+
+class NotFoundError(RiotApiError):
+    pass
+
+
+class _RateLimitBucket:
+    # Tracks the requests sent within each of the windows Riot reports in its rate limit headers, e.g. "20:1,100:120"
+    # is 20 requests per second and 100 per two minutes. Limits are unknown until a response reports them so only one
+    # request is let through before then, which has to release its probe however it ends.
+
+    def __init__(self, limiting_share: float):
+        self._limiting_share = limiting_share
+        self._windows: dict[int, tuple[int, collections.deque[float]]] = {}
+        self._known = asyncio.Event()
+        self._probing = False
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> bool:
+        # Returns whether the request is probing for the limits
+        while not self._known.is_set():
+            if not self._probing:
+                self._probing = True
+                return True
+            await self._known.wait()
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                wait = 0.0
+                for seconds, (limit, sent) in self._windows.items():
+                    while sent and sent[0] <= now - seconds:
+                        sent.popleft()
+                    if len(sent) >= max(1, int(limit * self._limiting_share)):
+                        wait = max(wait, sent[0] + seconds - now)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            for _, sent in self._windows.values():
+                sent.append(now)
+        return False
+
+    def update(self, limits_header: str | None, counts_header: str | None):
+        if limits_header:
+            now = time.monotonic()
+            counts = _parse_rate_limit_header(counts_header or "")
+            windows = {}
+            for seconds, limit in _parse_rate_limit_header(limits_header).items():
+                _, sent = self._windows.get(seconds, (limit, collections.deque()))
+                # Requests from other clients or previous runs share the same limits, so trust Riot's count when it
+                # is higher than ours
+                sent.extend(now for _ in range(counts.get(seconds, 0) - len(sent)))
+                windows[seconds] = (limit, sent)
+            self._windows = windows
+
+    def release(self):
+        self._probing = False
+        if self._windows:
+            self._known.set()
+        else:
+            # Responses without limits (e.g. timeouts) don't make them known, so wake the waiting requests for one of
+            # them to probe instead
+            self._known.set()
+            self._known.clear()
+
+
+def _parse_rate_limit_header(header: str) -> dict[int, int]:
+    # "<limit or count>:<seconds>,..." -> {seconds: limit or count}
+    result = {}
+    for part in header.split(","):
+        if ":" in part:
+            value, seconds = part.split(":")
+            result[int(seconds)] = int(value)
+    return result
+
+
+@dataclasses.dataclass
+class _RetryPolicy:
+    strategy: str = "throw"
+    initial_backoff: float = 1.0
+    backoff_factor: float = 2.0
+    max_attempts: int = 1
+
+    def delay(self, attempt: int, response: httpx.Response | None) -> float | None:
+        # Returns how long to wait before retrying after the given (1-based) attempt failed, or None to give up
+        if self.strategy == "throw" or attempt >= self.max_attempts:
+            return None
+        if self.strategy == "exponential_backoff":
+            return self.initial_backoff * self.backoff_factor ** (attempt - 1)
+        if self.strategy == "retry_from_headers":
+            if response is not None and "Retry-After" in response.headers:
+                return float(response.headers["Retry-After"])
+            return _DEFAULT_RETRY_AFTER_SECONDS
+        raise ValueError(f"Unknown request error handling strategy {self.strategy}")
+
+
+def _retry_policies(request_error_handling: dict[str, Any]) -> dict[str, _RetryPolicy]:
+    # Keyed by status code, with 429s keyed by the reported limit type (e.g. "429.method"), and "timeout"
+    policies = {}
+    for key, config in request_error_handling.items():
+        if "strategy" in config:
+            policies[key] = _RetryPolicy(**config)
+        else:
+            for limit_type, limit_config in config.items():
+                policies[f"{key}.{limit_type}"] = _RetryPolicy(**limit_config)
+    return policies
+
+
+class RiotApiClient:
+    def __init__(self, api_key: str, limiting_share: float = 1.0, request_error_handling: dict[str, Any] | None = None):
+        self._http = httpx.AsyncClient(headers={"X-Riot-Token": api_key}, timeout=_REQUEST_TIMEOUT_SECONDS)
+        self._limiting_share = limiting_share
+        self._retry_policies = _retry_policies(request_error_handling or {})
+        # host -> application bucket, (host, method) -> method bucket
+        self._app_buckets: dict[str, _RateLimitBucket] = {}
+        self._method_buckets: dict[tuple[str, str], _RateLimitBucket] = {}
+
+    async def close(self):
+        await self._http.aclose()
+
+    async def get_account(self, name: str, tagline: str, region: cass.Region) -> dict[str, Any]:
+        data = await self._get(
+            _continent_host(region.platform),
+            "account-by-riot-id",
+            f"/riot/account/v1/accounts/by-riot-id/{name}/{tagline}",
+        )
+        data["region"] = region.value
+        return cass_account.AccountData(**data).to_dict()
+
+    async def get_summoner(self, puuid: str, region: cass.Region) -> dict[str, Any]:
+        data = await self._get(
+            _platform_host(region.platform), "summoner-by-puuid", f"/lol/summoner/v4/summoners/by-puuid/{puuid}"
+        )
+        data["region"] = region.value
+        return cass_summoner.SummonerData(**data).to_dict()
+
+    async def get_match_ids(
+        self,
+        puuid: str,
+        region: cass.Region,
+        start: int = 0,
+        count: int = MATCH_IDS_PAGE_SIZE,
+        start_time: datetime.datetime | None = None,
+    ) -> list[str]:
+        # Newest first, in Riot's "<platform>_<id>" form
+        params: dict[str, Any] = {"start": start, "count": count}
+        if start_time is not None:
+            params["startTime"] = int(start_time.timestamp())
+        try:
+            return await self._get(
+                _continent_host(region.platform),
+                "match-ids-by-puuid",
+                f"/lol/match/v5/matches/by-puuid/{puuid}/ids",
+                params,
+            )
+        except NotFoundError:
+            return []
+
+    async def get_match(self, platform: cass.Platform, match_id: str) -> dict[str, Any]:
+        # Returns the match in the same form as cassiopeia's Match.to_dict() so stored matches don't depend on which
+        # client fetched them
+        data = (
+            await self._get(
+                _continent_host(platform), "match-by-id", f"/lol/match/v5/matches/{platform.value}_{match_id}"
+            )
+        )["info"]
+        data["continent"] = platform.continent.value
+        data["matchId"] = int(match_id)
+        for participant in data["participants"]:
+            participant["bot"] = participant.get("puuid") is None
+        return cass_match.MatchData(**data).to_dict()
+
+    async def get_active_game(self, puuid: str, region: cass.Region) -> dict[str, Any]:
+        # Raises NotFoundError if the summoner isn't in a game
+        return await self._get(
+            _platform_host(region.platform),
+            "active-game-by-puuid",
+            f"/lol/spectator/v5/active-games/by-summoner/{puuid}",
+        )
+
+    async def _get(self, host: str, method: str, path: str, params: dict[str, Any] | None = None) -> Any:
+        app_bucket = self._app_buckets.setdefault(host, _RateLimitBucket(self._limiting_share))
+        method_bucket = self._method_buckets.setdefault((host, method), _RateLimitBucket(self._limiting_share))
+
+        attempt = 0
+        while True:
+            attempt += 1
+            probes = []
+            cause = None
+            try:
+                with metrics.RIOT_API_RATE_LIMIT_WAIT_SECONDS.labels(method).time():
+                    for bucket in (app_bucket, method_bucket):
+                        if await bucket.acquire():
+                            probes.append(bucket)
+                start_time = time.monotonic()
+                try:
+                    response = await self._http.get(f"https://{host}.api.riotgames.com{path}", params=params)
+                except httpx.TimeoutException as e:
+                    metrics.RIOT_API_REQUEST_SECONDS.labels(method, "timeout").observe(time.monotonic() - start_time)
+                    policy_key, response, cause = "timeout", None, e
+                    error = RiotApiError(f"Timed out requesting {path}")
+                else:
+                    metrics.RIOT_API_REQUEST_SECONDS.labels(method, response.status_code).observe(
+                        time.monotonic() - start_time
+                    )
+                    app_bucket.update(
+                        response.headers.get("X-App-Rate-Limit"), response.headers.get("X-App-Rate-Limit-Count")
+                    )
+                    method_bucket.update(
+                        response.headers.get("X-Method-Rate-Limit"), response.headers.get("X-Method-Rate-Limit-Count")
+                    )
+                    logger.debug(f"GET {path} {params or ""} -> {response.status_code}")
+                    if response.is_success:
+                        return response.json()
+
+                    policy_key = str(response.status_code)
+                    if response.status_code == 429:
+                        policy_key += f".{response.headers.get("X-Rate-Limit-Type", "service")}"
+                    error_type = NotFoundError if response.status_code == 404 else RiotApiError
+                    error = error_type(f"{response.status_code} requesting {path}")
+            finally:
+                # Including when cancelled while waiting on the other bucket, which would otherwise leave the probing
+                # bucket's requests waiting forever
+                for bucket in probes:
+                    bucket.release()
+
+            delay = self._retry_policies.get(policy_key, _RetryPolicy()).delay(attempt, response)
+            if delay is None:
+                raise error from cause
+            logger.info(f"Retrying {path} in {delay:.1f}s after {error}")
+            metrics.RIOT_API_RETRIES.labels(method, policy_key).inc()
+            await asyncio.sleep(delay)
+
+
+def _platform_host(platform: cass.Platform) -> str:
+    return platform.value.lower()
+
+
+def _continent_host(platform: cass.Platform) -> str:
+    return platform.continent.value.lower()
+
+
+def client() -> RiotApiClient:
+    global _client
+    if _client is None:
+        riot_api_settings = settings.riot_api_settings()
+        _client = RiotApiClient(
+            settings.riot_api_key(),
+            limiting_share=riot_api_settings.get("limiting_share", 1.0),
+            request_error_handling=riot_api_settings.get("request_error_handling"),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
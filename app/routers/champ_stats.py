@@ -0,0 +1,229 @@
+import datetime
+import logging
+from typing import Annotated, Any
+
+import cassiopeia as cass
+import fastapi
+import psycopg as pg
+import pydantic
+from psycopg import sql
+
+from app import champions, db, lru_cache, metrics, model
+from app.routers import summoner as summoner_api
+
+router = fastapi.APIRouter()
+
+logger = logging.getLogger(__name__)
+
+# The global ("*") and per-summoner buckets come from one scan, like champion win rates. Stats can be missing from
+# imported matches, in which case a champion's sums would otherwise be NULL.
+_KDAS_QUERY = sql.SQL(
+    """
+WITH scanned AS (
+    SELECT
+        CASE WHEN puuid = ANY(%(puuid_list)s) THEN puuid END AS puuid,
+        champion_id,
+        champion_name,
+        platform,
+        kills,
+        deaths,
+        assists
+    FROM match_participants
+    WHERE {filter_expr}
+)
+SELECT
+    puuid,
+    champion_id AS champ_id,
+    ANY_VALUE(champion_name) AS champ_name,
+    ANY_VALUE(platform) AS platform,
+    COUNT(*) AS games,
+    COALESCE(SUM(kills), 0)::bigint AS kills,
+    COALESCE(SUM(deaths), 0)::bigint AS deaths,
+    COALESCE(SUM(assists), 0)::bigint AS assists
+FROM scanned
+GROUP BY GROUPING SETS ((champion_id), (puuid, champion_id))
+HAVING GROUPING(puuid) = 1 OR puuid IS NOT NULL;
+"""
+)
+
+# Each summoner's best game on each champion they've played is the first entry of its range of
+# idx_match_participants_puuid_champion_id_damage which passes the filters, rather than an aggregate over all of them.
+_PERSONAL_BESTS_QUERY = sql.SQL(
+    """
+WITH played AS (
+    SELECT DISTINCT puuid, champion_id
+    FROM match_participants
+    WHERE puuid = ANY(%(puuid_list)s)
+)
+SELECT
+    played.puuid,
+    played.champion_id AS champ_id,
+    best.champion_name AS champ_name,
+    best.platform,
+    best.champion_damage AS damage,
+    best.start_time
+FROM played
+CROSS JOIN LATERAL (
+    SELECT champion_name, platform, champion_damage, start_time
+    FROM match_participants
+    WHERE match_participants.puuid = played.puuid
+        AND match_participants.champion_id = played.champion_id
+        AND match_participants.champion_damage IS NOT NULL
+        AND {filter_expr}
+    ORDER BY match_participants.champion_damage DESC NULLS LAST
+    LIMIT 1
+) AS best;
+"""
+)
+
+_GLOBAL_PERSONAL_BESTS_QUERY = sql.SQL(
+    """
+SELECT DISTINCT ON (champion_id)
+    NULL AS puuid,
+    champion_id AS champ_id,
+    champion_name AS champ_name,
+    platform,
+    champion_damage AS damage,
+    start_time
+FROM match_participants
+WHERE {filter_expr}
+    AND champion_damage IS NOT NULL
+ORDER BY champion_id, champion_damage DESC;
+"""
+)
+
+_RESULT_CACHE_SIZE = 256
+
+
+class ChampionStatsRequest(pydantic.BaseModel):
+    summoners: list[model.Summoner] = pydantic.Field(default_factory=list)
+    match_filters: model.MatchFilters = pydantic.Field(default_factory=model.MatchFilters)
+
+
+class ChampionKda(pydantic.BaseModel):
+    games: int = 0
+    kills: int = 0
+    deaths: int = 0
+    assists: int = 0
+    kda: float = 0.0
+
+
+class PerChampionKdas(pydantic.BaseModel):
+    per_champ: dict[str, ChampionKda] = pydantic.Field(default_factory=dict)
+
+
+class PerSummonerKdas(pydantic.BaseModel):
+    per_summoner: dict[str, PerChampionKdas] = pydantic.Field(default_factory=dict)
+
+
+class PersonalBest(pydantic.BaseModel):
+    damage: int = 0
+    start_time: datetime.datetime | None = None
+
+
+class PerChampionPersonalBests(pydantic.BaseModel):
+    per_champ: dict[str, PersonalBest] = pydantic.Field(default_factory=dict)
+
+
+class PerSummonerPersonalBests(pydantic.BaseModel):
+    per_summoner: dict[str, PerChampionPersonalBests] = pydantic.Field(default_factory=dict)
+
+
+# (endpoint, matches generation, canonical request) -> result
+_RESULT_CACHE: lru_cache.LruCache[tuple[str, int, str], pydantic.BaseModel] = lru_cache.LruCache(_RESULT_CACHE_SIZE)
+metrics.register_cache("champion_stats", _RESULT_CACHE)
+
+
+def _canonical_request(request: ChampionStatsRequest) -> str:
+    # The order of summoners doesn't affect the result
+    return ChampionStatsRequest(
+        summoners=sorted(request.summoners, key=lambda summoner: summoner.encode()),
+        match_filters=request.match_filters,
+    ).model_dump_json()
+
+
+def _champ_name(row: dict[str, Any]) -> str:
+    return champions.get_name(row["champ_id"], cass.Region.from_platform(row["platform"])) or row["champ_name"]
+
+
+async def _fetch(
+    query_name: str, conn: pg.AsyncConnection, query: sql.Composable, params: dict[str, Any]
+) -> list[dict[str, Any]]:
+    with metrics.QUERY_SECONDS.labels(query_name).time():
+        rows = await (await conn.execute(query, params)).fetchall()
+    metrics.QUERY_ROWS.labels(query_name).observe(len(rows))
+    await champions.ensure_loaded(cass.Region.from_platform(row["platform"]) for row in rows)
+    return rows
+
+
+@router.post("/v1/query/champion_kdas")
+async def get_champ_kdas(
+    request: ChampionStatsRequest,
+    conn: Annotated[pg.AsyncConnection, fastapi.Depends(db.get_async_connection)],
+) -> PerSummonerKdas:
+    summoner_api.validate_summoners(request.summoners)
+
+    cache_key = ("champion_kdas", await db.matches_generation(conn), _canonical_request(request))
+    cached_result = _RESULT_CACHE.get(cache_key)
+    if cached_result is not None:
+        return cached_result
+
+    puuids = await summoner_api.resolve_unique_puuids(request.summoners, conn)
+    summoner_map: dict[str, model.Summoner] = dict(zip(puuids, request.summoners))
+    rows = await _fetch(
+        "champion_kdas",
+        conn,
+        _KDAS_QUERY.format(filter_expr=request.match_filters.sql_filter_expression("match_participants")),
+        request.match_filters.sql_filter_params() | {"puuid_list": puuids},
+    )
+
+    result = PerSummonerKdas(per_summoner={"*": PerChampionKdas()})
+    for row in rows:
+        summoner_key = summoner_map[row["puuid"]].encode() if row["puuid"] is not None else "*"
+        if summoner_key not in result.per_summoner:
+            result.per_summoner[summoner_key] = PerChampionKdas()
+        result.per_summoner[summoner_key].per_champ[_champ_name(row)] = ChampionKda(
+            games=row["games"],
+            kills=row["kills"],
+            deaths=row["deaths"],
+            assists=row["assists"],
+            # Deathless games count as one death so that the ratio stays finite
+            kda=(row["kills"] + row["assists"]) / max(row["deaths"], 1),
+        )
+
+    _RESULT_CACHE.put(cache_key, result)
+    return result
+
+
+@router.post("/v1/query/personal_bests")
+async def get_personal_bests(
+    request: ChampionStatsRequest,
+    conn: Annotated[pg.AsyncConnection, fastapi.Depends(db.get_async_connection)],
+) -> PerSummonerPersonalBests:
+    summoner_api.validate_summoners(request.summoners)
+
+    cache_key = ("personal_bests", await db.matches_generation(conn), _canonical_request(request))
+    cached_result = _RESULT_CACHE.get(cache_key)
+    if cached_result is not None:
+        return cached_result
+
+    puuids = await summoner_api.resolve_unique_puuids(request.summoners, conn)
+    summoner_map: dict[str, model.Summoner] = dict(zip(puuids, request.summoners))
+    filter_expr = request.match_filters.sql_filter_expression("match_participants")
+    params = request.match_filters.sql_filter_params() | {"puuid_list": puuids}
+    rows = await _fetch(
+        "personal_bests_global", conn, _GLOBAL_PERSONAL_BESTS_QUERY.format(filter_expr=filter_expr), params
+    )
+    rows += await _fetch("personal_bests", conn, _PERSONAL_BESTS_QUERY.format(filter_expr=filter_expr), params)
+
+    result = PerSummonerPersonalBests(per_summoner={"*": PerChampionPersonalBests()})
+    for row in rows:
+        summoner_key = summoner_map[row["puuid"]].encode() if row["puuid"] is not None else "*"
+        if summoner_key not in result.per_summoner:
+            result.per_summoner[summoner_key] = PerChampionPersonalBests()
+        result.per_summoner[summoner_key].per_champ[_champ_name(row)] = PersonalBest(
+            damage=row["damage"], start_time=row["start_time"]
+        )
+
+    _RESULT_CACHE.put(cache_key, result)
+    return result
@@ -1,81 +1,106 @@
 import asyncio
+import io
 import logging
 import pprint
+from typing import Annotated, Any, AsyncIterator
 
 import cassiopeia as cass
 import fastapi
+import psycopg as pg
+import pyarrow as pa
 import pydantic
-from datapipelines import common as dp_common
+from fastapi import responses
 from psycopg import sql
 
-from app import db, model, settings, validation
+from app import champions, db, encode, lru_cache, metrics, model, settings
 from app.routers import summoner as summoner_api
 
 router = fastapi.APIRouter()
 
 logger = logging.getLogger(__name__)
 
-_GLOBAL_QUERY = sql.SQL(
+# Every filter variant and both the global ("*") and per-summoner buckets are computed from a single scan of
+# match_participants: each participant is tagged with the variants it matches and grouped with GROUPING SETS. Whole
+# days within a variant's time range are read from the rollup, so the global buckets only count participants on the
+# partial days at its edges.
+_WIN_RATES_QUERY = sql.SQL(
     """
-WITH map_step AS (
-    SELECT match_data, JSONB_ARRAY_ELEMENTS(match_data -> 'participants') as participants
-    FROM matches
-), filter_step AS (
-    SELECT *
-    FROM map_step
-    WHERE {filter_expr}
-), reduce_step AS (
+WITH scanned AS (
     SELECT
-        (participants->'championId')::int AS champ_id,
-        ANY_VALUE(participants->>'championName') AS champ_name,
-        ANY_VALUE(match_data) AS match_data,
-        SUM((participants->'stats'->'win')::bool::int) AS wins,
-        COUNT(*) AS games
-    FROM filter_step
-    GROUP BY participants->'championId')
-SELECT
-    champ_id,
-    champ_name,
-    match_data->>'platform' AS platform,
-    wins,
-    games,
-    wins::float/games AS win_rate
-FROM reduce_step;
-"""
-)
-
-_PER_SUMMONER_QUERY = sql.SQL(
-    """
-WITH map_step AS (
-    SELECT match_data, JSONB_ARRAY_ELEMENTS(match_data -> 'participants') as participants
-    FROM matches
-), filter_step AS (
-    SELECT *
-    FROM map_step
-    WHERE {filter_expr}
-        AND participants->>'puuid' = ANY(%(puuid_list)s)
-), reduce_step AS (
+        variants.variant,
+        CASE WHEN match_participants.puuid = ANY(%(puuid_list)s) THEN match_participants.puuid END AS puuid,
+        variants.outside_rollup,
+        match_participants.champion_id,
+        match_participants.champion_name,
+        match_participants.platform,
+        match_participants.win::int AS wins
+    FROM match_participants
+    CROSS JOIN LATERAL (VALUES {variant_rows}) AS variants(variant, matched, outside_rollup)
+    WHERE ({scan_expr})
+        AND variants.matched
+        AND (variants.outside_rollup OR match_participants.puuid = ANY(%(puuid_list)s))
+),
+grouped AS (
     SELECT
-        participants->>'puuid' AS puuid,
-        (participants->'championId')::int AS champ_id,
-        ANY_VALUE(participants->>'championName') AS champ_name,
-        ANY_VALUE(match_data) AS match_data,
-        SUM((participants->'stats'->'win')::bool::int) AS wins,
-        COUNT(*) AS games
-    FROM filter_step
-    GROUP BY puuid, participants->'championId')
+        variant,
+        puuid,
+        GROUPING(puuid) = 1 AS is_global,
+        champion_id,
+        ANY_VALUE(champion_name) AS champion_name,
+        ANY_VALUE(platform) AS platform,
+        CASE WHEN GROUPING(puuid) = 1 THEN SUM(wins) FILTER (WHERE outside_rollup) ELSE SUM(wins) END AS wins,
+        CASE WHEN GROUPING(puuid) = 1 THEN COUNT(*) FILTER (WHERE outside_rollup) ELSE COUNT(*) END AS games
+    FROM scanned
+    GROUP BY GROUPING SETS ((variant, champion_id), (variant, puuid, champion_id))
+),
+combined AS (
+    SELECT variant, puuid, champion_id, champion_name, platform, wins, games
+    FROM grouped
+    WHERE games > 0 AND (is_global OR puuid IS NOT NULL)
+    UNION ALL
+    {rollup_queries}
+)
 SELECT
+    variant,
     puuid,
-    champ_id,
-    champ_name,
-    match_data->>'platform' AS platform,
-    wins,
-    games,
-    wins::float/games AS win_rate
-FROM reduce_step;
+    champion_id AS champ_id,
+    ANY_VALUE(champion_name) AS champ_name,
+    ANY_VALUE(platform) AS platform,
+    SUM(wins)::bigint AS wins,
+    SUM(games)::bigint AS games,
+    SUM(wins)::float/SUM(games) AS win_rate
+FROM combined
+GROUP BY variant, puuid, champion_id
+ORDER BY variant, puuid NULLS FIRST, champ_id;
 """
 )
 
+_ROLLUP_QUERY = sql.SQL(
+    """SELECT {variant} AS variant, NULL AS puuid, champion_id, champion_name, platform, wins, games
+    FROM champion_win_rate_rollup
+    WHERE {rollup_filter_expr}"""
+)
+
+
+_RESULT_CACHE_SIZE = 256
+
+_STREAM_BATCH_SIZE = 1024
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+_ARROW_SCHEMA = pa.schema(
+    [
+        ("summoner", pa.string()),
+        ("champion_id", pa.int32()),
+        ("champion", pa.string()),
+        ("wins", pa.int64()),
+        ("games", pa.int64()),
+        ("rate", pa.float64()),
+    ]
+)
+
 
 class ChampionWinRatesRequest(pydantic.BaseModel):
     summoners: list[model.Summoner] = pydantic.Field(default_factory=list)
@@ -96,72 +121,200 @@ class PerSummonerWinRates(pydantic.BaseModel):
     per_summoner: dict[str, PerChampionWinRates] = pydantic.Field(default_factory=dict)
 
 
-@router.post("/v1/query/champion_win_rates")
-async def get_champ_win_rates(request: ChampionWinRatesRequest) -> PerSummonerWinRates:
-    if not validation.are_unique(request.summoners):
-        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail="Duplicate summoner")
-
-    accounts: list[cass.Account] = []
-    loop = asyncio.get_running_loop()
-    summoner_map: dict[str, model.Summoner] = {}
-    for summoner in request.summoners:
-        try:
-            accounts.append(await summoner_api.get_loaded_account(summoner))
-            summoner_map[accounts[-1].puuid] = summoner
-        except summoner_api.AccountNotFoundError as e:
-            raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail=str(e))
-
-    if not validation.are_unique(a.puuid for a in accounts):
-        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail="Duplicate account")
-
-    result = PerSummonerWinRates()
-    global_win_rates = PerChampionWinRates()
-    async with await db.async_connect() as conn:
-        async for row in await conn.execute(
-            _GLOBAL_QUERY.format(filter_expr=request.match_filters.sql_filter_expression()),
-            request.match_filters.sql_filter_params(),
-        ):
-            try:
-                champ = cass.Champion(id=row["champ_id"], region=cass.Region.from_platform(row["platform"]))
-                champ_name = await loop.run_in_executor(None, lambda: champ.name)
-            except dp_common.NotFoundError as e:
-                champ_name = row["champ_name"]
-
-            global_win_rates.per_champ[champ_name] = ChampionWinRate(
-                wins=row["wins"], games=row["games"], rate=row["win_rate"]
+# (matches generation, canonical request) -> result
+_RESULT_CACHE: lru_cache.LruCache[tuple[int, str], PerSummonerWinRates] = lru_cache.LruCache(_RESULT_CACHE_SIZE)
+metrics.register_cache("champion_win_rates", _RESULT_CACHE)
+
+
+def _canonical_request(request: ChampionWinRatesRequest) -> str:
+    # The order of summoners doesn't affect the result
+    return ChampionWinRatesRequest(
+        summoners=sorted(request.summoners, key=lambda summoner: summoner.encode()),
+        match_filters=request.match_filters,
+    ).model_dump_json()
+
+
+def _win_rates_query(variants: list[model.MatchFilters], puuids: list[str]) -> tuple[sql.Composable, dict[str, Any]]:
+    # Rows are keyed by the index of the variant they were computed for, with a NULL puuid for the global buckets
+    variant_rows = []
+    scan_disjunctions = []
+    rollup_queries = []
+    params: dict[str, Any] = {"puuid_list": puuids}
+    for index, match_filters in enumerate(variants):
+        prefix = f"variant{index}"
+        first_day, end_day = match_filters.whole_days()
+        day_conjunctions = []
+        window_conjunctions = []
+        if first_day is not None:
+            day_conjunctions.append(
+                sql.SQL("champion_win_rate_rollup.day >= {0}").format(sql.Placeholder(f"{prefix}.rollup_first_day"))
+            )
+            window_conjunctions.append(
+                sql.SQL("match_participants.start_time >= {0}").format(
+                    sql.Placeholder(f"{prefix}.rollup_first_day_start")
+                )
+            )
+        if end_day is not None:
+            day_conjunctions.append(
+                sql.SQL("champion_win_rate_rollup.day < {0}").format(sql.Placeholder(f"{prefix}.rollup_end_day"))
+            )
+            window_conjunctions.append(
+                sql.SQL("match_participants.start_time < {0}").format(sql.Placeholder(f"{prefix}.rollup_end_day_start"))
+            )
+
+        filter_expr = match_filters.sql_filter_expression("match_participants", prefix)
+        outside_rollup_expr = sql.SQL("NOT ({0})").format(
+            sql.SQL(" AND ").join(window_conjunctions) if window_conjunctions else sql.SQL("TRUE")
+        )
+        variant_rows.append(sql.SQL("({0}, {1}, {2})").format(sql.Literal(index), filter_expr, outside_rollup_expr))
+        # Repeated outside of the lateral join so that the planner can use the indexes on match_participants
+        scan_disjunctions.append(
+            sql.SQL("({0} AND ({1} OR match_participants.puuid = ANY(%(puuid_list)s)))").format(
+                filter_expr, outside_rollup_expr
             )
-        result.per_summoner["*"] = global_win_rates
-
-        async for row in await conn.execute(
-            _PER_SUMMONER_QUERY.format(filter_expr=request.match_filters.sql_filter_expression()),
-            request.match_filters.sql_filter_params() | {"puuid_list": [a.puuid for a in accounts]},
-        ):
-            try:
-                champ = cass.Champion(id=row["champ_id"], region=cass.Region.from_platform(row["platform"]))
-                champ_name = await loop.run_in_executor(None, lambda: champ.name)
-            except dp_common.NotFoundError as e:
-                champ_name = row["champ_name"]
-
-            summoner_key = summoner_map[row["puuid"]].encode()
-
-            if summoner_key not in result.per_summoner:
-                result.per_summoner[summoner_key] = PerChampionWinRates()
-            result.per_summoner[summoner_key].per_champ[champ_name] = ChampionWinRate(
-                wins=row["wins"], games=row["games"], rate=row["win_rate"]
+        )
+
+        non_time_filters = match_filters.model_copy(update={"after": None, "before": None})
+        rollup_queries.append(
+            _ROLLUP_QUERY.format(
+                variant=sql.Literal(index),
+                rollup_filter_expr=sql.SQL(" AND ").join(
+                    [non_time_filters.sql_filter_expression("champion_win_rate_rollup", prefix)] + day_conjunctions
+                ),
             )
+        )
+        params |= match_filters.sql_filter_params(prefix) | {
+            f"{prefix}.rollup_first_day": first_day,
+            f"{prefix}.rollup_end_day": end_day,
+            f"{prefix}.rollup_first_day_start": model.day_start(first_day),
+            f"{prefix}.rollup_end_day_start": model.day_start(end_day),
+        }
+
+    query = _WIN_RATES_QUERY.format(
+        variant_rows=sql.SQL(", ").join(variant_rows),
+        scan_expr=sql.SQL(" OR ").join(scan_disjunctions),
+        rollup_queries=sql.SQL("\n    UNION ALL\n    ").join(rollup_queries),
+    )
+    return query, params
+
 
+def _champ_name(row: dict[str, Any]) -> str:
+    return champions.get_name(row["champ_id"], cass.Region.from_platform(row["platform"])) or row["champ_name"]
+
+
+async def _iterate_win_rate_rows(request: ChampionWinRatesRequest, puuids: list[str]) -> AsyncIterator[dict[str, Any]]:
+    summoner_map: dict[str, model.Summoner] = dict(zip(puuids, request.summoners))
+
+    # The request's connection may be released before the response has been streamed, so use a separate one
+    async with db.async_pooled_connection() as conn, conn.transaction():
+        row_count = 0
+        async with conn.cursor(name="champion_win_rates_stream") as cursor:
+            cursor.itersize = _STREAM_BATCH_SIZE
+            with metrics.QUERY_SECONDS.labels("champion_win_rates_stream").time():
+                await cursor.execute(*_win_rates_query([request.match_filters], puuids))
+            async for row in cursor:
+                row_count += 1
+                await champions.ensure_loaded([cass.Region.from_platform(row["platform"])])
+                yield {
+                    "summoner": summoner_map[row["puuid"]].encode() if row["puuid"] is not None else "*",
+                    "champion_id": row["champ_id"],
+                    "champion": _champ_name(row),
+                    "wins": row["wins"],
+                    "games": row["games"],
+                    "rate": row["win_rate"],
+                }
+        metrics.QUERY_ROWS.labels("champion_win_rates_stream").observe(row_count)
+
+
+async def _ndjson_stream(rows: AsyncIterator[dict[str, Any]]) -> AsyncIterator[bytes]:
+    async for row in rows:
+        yield encode.dumps(row) + b"\n"
+
+
+async def _arrow_stream(rows: AsyncIterator[dict[str, Any]]) -> AsyncIterator[bytes]:
+    sink = io.BytesIO()
+
+    def take_written() -> bytes:
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    with pa.ipc.new_stream(sink, _ARROW_SCHEMA) as writer:
+        batch = []
+        async for row in rows:
+            batch.append(row)
+            if len(batch) >= _STREAM_BATCH_SIZE:
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=_ARROW_SCHEMA))
+                batch = []
+                yield take_written()
+        if batch:
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=_ARROW_SCHEMA))
+    yield take_written()
+
+
+@router.post("/v1/query/champion_win_rates")
+async def get_champ_win_rates(
+    request: ChampionWinRatesRequest,
+    conn: Annotated[pg.AsyncConnection, fastapi.Depends(db.get_async_connection)],
+) -> PerSummonerWinRates:
+    summoner_api.validate_summoners(request.summoners)
+
+    cache_key = (await db.matches_generation(conn), _canonical_request(request))
+    cached_result = _RESULT_CACHE.get(cache_key)
+    if cached_result is not None:
+        return cached_result
+
+    puuids = await summoner_api.resolve_unique_puuids(request.summoners, conn)
+    summoner_map: dict[str, model.Summoner] = dict(zip(puuids, request.summoners))
+
+    with metrics.QUERY_SECONDS.labels("champion_win_rates").time():
+        rows = await (await conn.execute(*_win_rates_query([request.match_filters], puuids))).fetchall()
+    metrics.QUERY_ROWS.labels("champion_win_rates").observe(len(rows))
+    await champions.ensure_loaded(cass.Region.from_platform(row["platform"]) for row in rows)
+
+    result = PerSummonerWinRates(per_summoner={"*": PerChampionWinRates()})
+    for row in rows:
+        champ_name = _champ_name(row)
+        summoner_key = summoner_map[row["puuid"]].encode() if row["puuid"] is not None else "*"
+
+        if summoner_key not in result.per_summoner:
+            result.per_summoner[summoner_key] = PerChampionWinRates()
+        result.per_summoner[summoner_key].per_champ[champ_name] = ChampionWinRate(
+            wins=row["wins"], games=row["games"], rate=row["win_rate"]
+        )
+
+    _RESULT_CACHE.put(cache_key, result)
     return result
 
 
-if __name__ == "__main__":
-    settings.apply_global_settings()
-    logger.debug("Running /v1/query/champion_win_rates")
-    result = asyncio.run(
-        get_champ_win_rates(
+@router.post("/v1/query/champion_win_rates/stream")
+async def stream_champ_win_rates(
+    request: ChampionWinRatesRequest,
+    conn: Annotated[pg.AsyncConnection, fastapi.Depends(db.get_async_connection)],
+    accept: Annotated[str, fastapi.Header()] = NDJSON_MEDIA_TYPE,
+) -> responses.StreamingResponse:
+    summoner_api.validate_summoners(request.summoners)
+    rows = _iterate_win_rate_rows(request, await summoner_api.resolve_unique_puuids(request.summoners, conn))
+
+    if ARROW_STREAM_MEDIA_TYPE in accept:
+        return responses.StreamingResponse(_arrow_stream(rows), media_type=ARROW_STREAM_MEDIA_TYPE)
+    return responses.StreamingResponse(_ndjson_stream(rows), media_type=NDJSON_MEDIA_TYPE)
+
+
+async def _main() -> PerSummonerWinRates:
+    async with db.async_pooled_connection() as conn:
+        return await get_champ_win_rates(
             ChampionWinRatesRequest(
                 summoners=[model.Summoner(name="BasicBananas", tagline="000", region=cass.Region.north_america)],
-            )
+            ),
+            conn,
         )
-    )
+
+
+if __name__ == "__main__":
+    settings.apply_global_settings()
+    logger.debug("Running /v1/query/champion_win_rates")
+    result = asyncio.run(_main())
 
     pprint.pprint(result.model_dump())
@@ -0,0 +1,138 @@
+import logging
+from typing import Annotated, Any
+
+import cassiopeia as cass
+import fastapi
+import psycopg as pg
+import pydantic
+
+from app import champions, db, metrics, model, riot_api, settings
+from app.routers import summoner as summoner_api
+
+router = fastapi.APIRouter()
+
+logger = logging.getLogger(__name__)
+
+_MATCHUPS_QUERY = """
+SELECT
+    GROUPING(queue) = 1 AS all_queues,
+    queue,
+    champ_as,
+    champ_against,
+    SUM(wins)::bigint AS wins,
+    SUM(games)::bigint AS games
+FROM champion_matchups
+GROUP BY GROUPING SETS ((queue, champ_as, champ_against), (champ_as, champ_against));
+"""
+
+# Queue (None for all queues) -> (champion as, champion against) -> (wins, games). Rebuilt from champion_matchups
+# whenever matches have been stored since, so that live lookups don't have to query the DB.
+_matchups: dict[int | None, dict[tuple[int, int], tuple[int, int]]] = {}
+
+_matchups_generation: int | None = None
+
+
+class LiveParticipant(pydantic.BaseModel):
+    riot_id: str | None = None
+    champion: str
+
+
+class LiveMatchup(pydantic.BaseModel):
+    wins: int = 0
+    games: int = 0
+    rate: float | None = None
+
+
+class LiveMatchups(pydantic.BaseModel):
+    queue: int | None = None
+    allies: list[LiveParticipant] = pydantic.Field(default_factory=list)
+    enemies: list[LiveParticipant] = pydantic.Field(default_factory=list)
+    # matchups[i][j] is how allies[i]'s champion has done against enemies[j]'s
+    matchups: list[list[LiveMatchup]] = pydantic.Field(default_factory=list)
+
+
+async def refresh_matchups():
+    global _matchups, _matchups_generation
+    async with db.async_pooled_connection() as conn:
+        # Read before the matchups so that matches stored in between are picked up by the next refresh
+        generation = await db.matches_generation(conn)
+        if generation == _matchups_generation:
+            return
+
+        with metrics.QUERY_SECONDS.labels("live_matchups_refresh").time():
+            rows = await (await conn.execute(_MATCHUPS_QUERY)).fetchall()
+
+    matchups: dict[int | None, dict[tuple[int, int], tuple[int, int]]] = {}
+    for row in rows:
+        if not row["all_queues"] and row["queue"] is None:
+            continue
+        queue = None if row["all_queues"] else row["queue"]
+        matchups.setdefault(queue, {})[(row["champ_as"], row["champ_against"])] = (row["wins"], row["games"])
+
+    logger.info(f"Refreshed live matchups for {len(matchups)} queues at matches generation {generation}")
+    _matchups, _matchups_generation = matchups, generation
+
+
+def _parse_riot_id(summoner: str, region: cass.Region) -> model.Summoner:
+    name, separator, tagline = summoner.rpartition("#")
+    if not separator or not name or not tagline:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail=f"'{summoner}' is not a Riot ID (name#tagline)"
+        )
+    return model.Summoner(name=name, tagline=tagline, region=region)
+
+
+def _live_participant(participant: dict[str, Any], region: cass.Region) -> LiveParticipant:
+    champion_id = participant["championId"]
+    return LiveParticipant(
+        riot_id=participant.get("riotId"),
+        champion=champions.get_name(champion_id, region) or str(champion_id),
+    )
+
+
+def _live_matchup(matchups: dict[tuple[int, int], tuple[int, int]], champ_as: int, champ_against: int) -> LiveMatchup:
+    wins, games = matchups.get((champ_as, champ_against), (0, 0))
+    return LiveMatchup(wins=wins, games=games, rate=wins / games if games else None)
+
+
+@router.get("/v1/live/{summoner}")
+async def get_live_matchups(
+    summoner: str,
+    conn: Annotated[pg.AsyncConnection, fastapi.Depends(db.get_async_connection)],
+    region: cass.Region | None = None,
+) -> LiveMatchups:
+    # `summoner` is a Riot ID, with its '#' escaped as %23
+    summoner_info = _parse_riot_id(summoner, region or settings.default_region())
+    try:
+        puuid = (await summoner_api.resolve_puuids([summoner_info], conn))[0]
+    except summoner_api.AccountNotFoundError as e:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail=str(e))
+
+    try:
+        game = await riot_api.client().get_active_game(puuid, summoner_info.region)
+    except riot_api.NotFoundError:
+        raise fastapi.HTTPException(
+            status_code=fastapi.status.HTTP_404_NOT_FOUND, detail=f"{summoner_info.encode()} is not in a game"
+        )
+
+    # Spectator data can hide the puuids of some players, in which case their team is shown first
+    own_team = next(
+        (participant["teamId"] for participant in game["participants"] if participant.get("puuid") == puuid),
+        game["participants"][0]["teamId"],
+    )
+    allies = [participant for participant in game["participants"] if participant["teamId"] == own_team]
+    enemies = [participant for participant in game["participants"] if participant["teamId"] != own_team]
+
+    # Fall back to every queue if none of the queue's matches have been stored
+    queue = game.get("gameQueueConfigId")
+    matchups = _matchups.get(queue) or _matchups.get(None, {})
+
+    await champions.ensure_loaded([summoner_info.region])
+    return LiveMatchups(
+        queue=queue,
+        allies=[_live_participant(participant, summoner_info.region) for participant in allies],
+        enemies=[_live_participant(participant, summoner_info.region) for participant in enemies],
+        matchups=[
+            [_live_matchup(matchups, ally["championId"], enemy["championId"]) for enemy in enemies] for ally in allies
+        ],
+    )
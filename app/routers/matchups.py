@@ -0,0 +1,165 @@
+import asyncio
+import logging
+from typing import Annotated, Any
+
+import cassiopeia as cass
+import fastapi
+import psycopg as pg
+import pydantic
+from psycopg import sql
+
+from app import champions, db, lru_cache, matchup_engine, metrics, model
+from app.routers import summoner as summoner_api
+
+router = fastapi.APIRouter()
+
+logger = logging.getLogger(__name__)
+
+# Whole days within the filtered range are read from champion_matchups, and only the matches on the partial days at
+# its edges are paired up from their participants.
+_MATCHUPS_QUERY = sql.SQL(
+    """
+WITH combined AS (
+    SELECT champ_as, champ_against, champ_as_name, champ_against_name, platform, wins, games
+    FROM champion_matchups
+    WHERE {rollup_filter_expr}
+    UNION ALL
+    SELECT
+        match_participants.champion_id,
+        against.champion_id,
+        match_participants.champion_name,
+        against.champion_name,
+        match_participants.platform,
+        match_participants.win::int,
+        1
+    FROM match_participants
+    JOIN match_participants AS against
+        ON against.match_id = match_participants.match_id AND against.side <> match_participants.side
+    WHERE {filter_expr}
+        AND NOT ({rollup_window_expr})
+)
+SELECT
+    champ_as,
+    champ_against,
+    ANY_VALUE(champ_as_name) AS champ_as_name,
+    ANY_VALUE(champ_against_name) AS champ_against_name,
+    ANY_VALUE(platform) AS platform,
+    SUM(wins)::bigint AS wins,
+    SUM(games)::bigint AS games,
+    SUM(wins)::float/SUM(games) AS win_rate
+FROM combined
+GROUP BY champ_as, champ_against;
+"""
+)
+
+_RESULT_CACHE_SIZE = 64
+
+
+class MatchupsRequest(pydantic.BaseModel):
+    # Only counts the matches which one of these summoners played in, if any are given
+    summoners: list[model.Summoner] = pydantic.Field(default_factory=list)
+    match_filters: model.MatchFilters = pydantic.Field(default_factory=model.MatchFilters)
+
+
+class MatchupWinRate(pydantic.BaseModel):
+    wins: int = 0
+    games: int = 0
+    rate: float = 0.0
+
+
+class Matchups(pydantic.BaseModel):
+    # Champion as -> champion against -> win rate of the former
+    per_champ: dict[str, dict[str, MatchupWinRate]] = pydantic.Field(default_factory=dict)
+
+
+# (matches generation, request) -> result
+_RESULT_CACHE: lru_cache.LruCache[tuple[int, str], Matchups] = lru_cache.LruCache(_RESULT_CACHE_SIZE)
+metrics.register_cache("matchups", _RESULT_CACHE)
+
+
+def _matchups_query(match_filters: model.MatchFilters) -> tuple[sql.Composable, dict[str, Any]]:
+    first_day, end_day = match_filters.whole_days()
+    day_conjunctions = []
+    window_conjunctions = []
+    if first_day is not None:
+        day_conjunctions.append(sql.SQL("champion_matchups.day >= %(rollup_first_day)s"))
+        window_conjunctions.append(sql.SQL("match_participants.start_time >= %(rollup_first_day_start)s"))
+    if end_day is not None:
+        day_conjunctions.append(sql.SQL("champion_matchups.day < %(rollup_end_day)s"))
+        window_conjunctions.append(sql.SQL("match_participants.start_time < %(rollup_end_day_start)s"))
+
+    non_time_filters = match_filters.model_copy(update={"after": None, "before": None})
+    query = _MATCHUPS_QUERY.format(
+        rollup_filter_expr=sql.SQL(" AND ").join(
+            [non_time_filters.sql_filter_expression("champion_matchups")] + day_conjunctions
+        ),
+        filter_expr=match_filters.sql_filter_expression("match_participants"),
+        rollup_window_expr=sql.SQL(" AND ").join(window_conjunctions) if window_conjunctions else sql.SQL("TRUE"),
+    )
+    params = match_filters.sql_filter_params() | {
+        "rollup_first_day": first_day,
+        "rollup_end_day": end_day,
+        "rollup_first_day_start": model.day_start(first_day),
+        "rollup_end_day_start": model.day_start(end_day),
+    }
+    return query, params
+
+
+def _champ_name(champ_id: int, stored_name: str | None, platform: str) -> str:
+    return champions.get_name(champ_id, cass.Region.from_platform(platform)) or stored_name or str(champ_id)
+
+
+async def _played_matchups(request: MatchupsRequest, conn: pg.AsyncConnection) -> matchup_engine.MatchupMatrices:
+    # champion_matchups doesn't know who played, so these matches are paired up from their participants
+    puuids = await summoner_api.resolve_unique_puuids(request.summoners, conn)
+    with metrics.QUERY_SECONDS.labels("matchups_played").time():
+        participants = await matchup_engine.load_participants(conn, request.match_filters, puuids)
+    metrics.QUERY_ROWS.labels("matchups_played").observe(len(participants.match_id))
+    # Pairing up a long history takes a while, which mustn't hold up the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, matchup_engine.compute, participants)
+
+
+def _matrices_result(matrices: matchup_engine.MatchupMatrices, region: cass.Region) -> Matchups:
+    names = [champions.get_name(champ_id, region) or str(champ_id) for champ_id in matrices.champion_ids.tolist()]
+    result = Matchups()
+    for i, j in zip(*matrices.against_games.nonzero()):
+        wins, games = int(matrices.against_wins[i, j]), int(matrices.against_games[i, j])
+        result.per_champ.setdefault(names[i], {})[names[j]] = MatchupWinRate(wins=wins, games=games, rate=wins / games)
+    return result
+
+
+@router.post("/v1/query/matchups")
+async def get_matchups(
+    request: MatchupsRequest,
+    conn: Annotated[pg.AsyncConnection, fastapi.Depends(db.get_async_connection)],
+) -> Matchups:
+    summoner_api.validate_summoners(request.summoners)
+
+    cache_key = (await db.matches_generation(conn), request.model_dump_json())
+    cached_result = _RESULT_CACHE.get(cache_key)
+    if cached_result is not None:
+        return cached_result
+
+    if request.summoners:
+        region = request.match_filters.region or request.summoners[0].region
+        matrices = await _played_matchups(request, conn)
+        await champions.ensure_loaded([region])
+        result = _matrices_result(matrices, region)
+        _RESULT_CACHE.put(cache_key, result)
+        return result
+
+    with metrics.QUERY_SECONDS.labels("matchups").time():
+        rows = await (await conn.execute(*_matchups_query(request.match_filters))).fetchall()
+    metrics.QUERY_ROWS.labels("matchups").observe(len(rows))
+    await champions.ensure_loaded(cass.Region.from_platform(row["platform"]) for row in rows)
+
+    result = Matchups()
+    for row in rows:
+        champ_as = _champ_name(row["champ_as"], row["champ_as_name"], row["platform"])
+        champ_against = _champ_name(row["champ_against"], row["champ_against_name"], row["platform"])
+        result.per_champ.setdefault(champ_as, {})[champ_against] = MatchupWinRate(
+            wins=row["wins"], games=row["games"], rate=row["win_rate"]
+        )
+
+    _RESULT_CACHE.put(cache_key, result)
+    return result
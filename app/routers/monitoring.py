@@ -0,0 +1,46 @@
+import fastapi
+import prometheus_client
+import pydantic
+from fastapi import responses
+
+from app import db
+
+router = fastapi.APIRouter()
+
+
+class DbPoolStats(pydantic.BaseModel):
+    min_size: int = 0
+    max_size: int = 0
+    size: int = 0
+    in_use: int = 0
+    available: int = 0
+    waiting: int = 0
+    requests: int = 0
+    acquire_wait_ms_total: int = 0
+    acquire_wait_ms_avg: float = 0.0
+
+
+@router.get("/v1/monitoring/db_pool")
+async def get_db_pool_stats() -> DbPoolStats:
+    stats = db.pool_stats()
+    if not stats:
+        return DbPoolStats()
+
+    requests = stats.get("requests_num", 0)
+    wait_ms = stats.get("requests_wait_ms", 0)
+    return DbPoolStats(
+        min_size=stats["pool_min"],
+        max_size=stats["pool_max"],
+        size=stats["pool_size"],
+        in_use=stats["pool_size"] - stats["pool_available"],
+        available=stats["pool_available"],
+        waiting=stats["requests_waiting"],
+        requests=requests,
+        acquire_wait_ms_total=wait_ms,
+        acquire_wait_ms_avg=wait_ms / requests if requests else 0.0,
+    )
+
+
+@router.get("/metrics")
+async def get_metrics() -> responses.Response:
+    return responses.Response(prometheus_client.generate_latest(), media_type=prometheus_client.CONTENT_TYPE_LATEST)
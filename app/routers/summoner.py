@@ -1,19 +1,25 @@
 import asyncio
-from typing import Any
+import dataclasses
+from typing import Annotated, Any, Sequence
 
 import cassiopeia as cass
 import fastapi
+import psycopg as pg
 import pydantic
-from datapipelines import common as dp_common
 from fastapi import status
 from psycopg import errors
 from psycopg.types import json
 
-from app import db, model, settings
+from app import db, lru_cache, metrics, model, riot_api, settings, validation
 
 router = fastapi.APIRouter()
 
 
+_PUUID_CACHE_SIZE = 4096
+
+_PUUID_CACHE_TTL_SECONDS = 3600
+
+
 class AccountNotFoundError(Exception):
     pass
 
@@ -29,51 +35,131 @@ class TrackedSummoner(pydantic.BaseModel):
     last_updated_match_id: str | None
 
 
-async def get_loaded_account(summoner_info: model.Summoner) -> cass.Account:
-    loop = asyncio.get_running_loop()
+@dataclasses.dataclass
+class LoadedAccount:
+    account_data: dict[str, Any]
+    summoner_data: dict[str, Any]
+
+    @property
+    def puuid(self) -> str:
+        return self.account_data["puuid"]
+
+
+# (name, tagline, region) -> puuid
+_PUUID_CACHE: lru_cache.LruCache[tuple[str, str, str], str] = lru_cache.LruCache(
+    _PUUID_CACHE_SIZE, ttl_seconds=_PUUID_CACHE_TTL_SECONDS
+)
+metrics.register_cache("puuids", _PUUID_CACHE)
+
+
+async def get_loaded_account(summoner_info: model.Summoner) -> LoadedAccount:
+    client = riot_api.client()
     try:
-        account = cass.Account(name=summoner_info.name, tagline=summoner_info.tagline, region=summoner_info.region)
-        await loop.run_in_executor(None, account.load)
-    except dp_common.NotFoundError:
-        AccountNotFoundError("Account not found")
+        account_data = await client.get_account(summoner_info.name, summoner_info.tagline, summoner_info.region)
+    except riot_api.NotFoundError:
+        raise AccountNotFoundError(f"Account {summoner_info.encode()} not found")
+
+    try:
+        summoner_data = await client.get_summoner(account_data["puuid"], summoner_info.region)
+    except riot_api.NotFoundError:
+        raise AccountNotFoundError(f"Summoner {summoner_info.encode()} not found")
+
+    return LoadedAccount(account_data=account_data, summoner_data=summoner_data)
+
+
+async def resolve_puuids(summoners: Sequence[model.Summoner], conn: pg.AsyncConnection) -> list[str]:
+    puuids: dict[model.Summoner, str] = {}
+    for summoner in summoners:
+        puuid = _PUUID_CACHE.get(_puuid_cache_key(summoner))
+        if puuid is not None:
+            puuids[summoner] = puuid
+
+    # Tracked summoners are the common case and their puuids are already stored
+    unresolved = [summoner for summoner in summoners if summoner not in puuids]
+    if unresolved:
+        cursor = await conn.execute(
+            """
+                SELECT requested.idx, tracked_summoners.account_data ->> 'puuid' AS puuid
+                FROM UNNEST(%s::text[], %s::text[], %s::text[]) WITH ORDINALITY AS requested(name, tagline, region, idx)
+                JOIN tracked_summoners
+                    ON LOWER(tracked_summoners.account_data ->> 'name') = LOWER(requested.name)
+                    AND LOWER(tracked_summoners.account_data ->> 'tagline') = LOWER(requested.tagline)
+                    AND tracked_summoners.summoner_data ->> 'region' = requested.region;
+            """,
+            (
+                [summoner.name for summoner in unresolved],
+                [summoner.tagline for summoner in unresolved],
+                [summoner.region.value for summoner in unresolved],
+            ),
+        )
+        async for row in cursor:
+            puuids[unresolved[row["idx"] - 1]] = row["puuid"]
 
+    unresolved = [summoner for summoner in summoners if summoner not in puuids]
+    accounts = await asyncio.gather(*(get_loaded_account(summoner) for summoner in unresolved))
+    for summoner, account in zip(unresolved, accounts):
+        puuids[summoner] = account.puuid
+
+    for summoner, puuid in puuids.items():
+        _PUUID_CACHE.put(_puuid_cache_key(summoner), puuid)
+    return [puuids[summoner] for summoner in summoners]
+
+
+def validate_summoners(summoners: Sequence[model.Summoner]):
+    if not validation.are_unique(summoners):
+        raise fastapi.HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Duplicate summoner")
+
+
+async def resolve_unique_puuids(summoners: Sequence[model.Summoner], conn: pg.AsyncConnection) -> list[str]:
+    # Like resolve_puuids, but reports unknown summoners and repeated accounts to the client
     try:
-        summoner = account.summoner
-        await loop.run_in_executor(None, summoner.load)
-    except dp_common.NotFoundError:
-        AccountNotFoundError("Summoner not found")
+        puuids = await resolve_puuids(summoners, conn)
+    except AccountNotFoundError as e:
+        raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
 
-    return account
+    if not validation.are_unique(puuids):
+        raise fastapi.HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Duplicate account")
+    return puuids
+
+
+def _puuid_cache_key(summoner: model.Summoner) -> tuple[str, str, str]:
+    # Riot IDs are case insensitive
+    return (summoner.name.lower(), summoner.tagline.lower(), summoner.region.value)
 
 
 @router.post("/v1/summoners")
-async def create_tracked_summoner(request: CreateTrackedSummonerRequest) -> TrackedSummoner:
+async def create_tracked_summoner(
+    request: CreateTrackedSummonerRequest,
+    conn: Annotated[pg.AsyncConnection, fastapi.Depends(db.get_async_connection)],
+) -> TrackedSummoner:
     try:
         account = await get_loaded_account(request)
     except AccountNotFoundError as e:
         raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail=str(e))
 
     try:
-        async with await db.async_connect() as conn:
-            async for item in await conn.execute(
-                """
-                    INSERT INTO tracked_summoners(account_data, summoner_data)
-                    VALUES (%s, %s)
-                    RETURNING id, account_data, summoner_data;
-                """,
-                (json.Jsonb(account.to_dict()), json.Jsonb(account.summoner.to_dict())),
-            ):
-                return TrackedSummoner.model_construct(**item)
+        async for item in await conn.execute(
+            """
+                INSERT INTO tracked_summoners(account_data, summoner_data)
+                VALUES (%s, %s)
+                RETURNING id, account_data, summoner_data;
+            """,
+            (json.Jsonb(account.account_data), json.Jsonb(account.summoner_data)),
+        ):
+            return TrackedSummoner.model_construct(**item)
     except errors.UniqueViolation:
         raise fastapi.HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Already exists")
 
     return fastapi.HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+async def _main():
+    async with db.async_pooled_connection() as conn:
+        await create_tracked_summoner(
+            CreateTrackedSummonerRequest(name="BasicBananas", tagline="000", region=cass.Region.north_america), conn
+        )
+
+
 if __name__ == "__main__":
     settings.apply_global_settings()
-    asyncio.run(
-        create_tracked_summoner(
-            CreateTrackedSummonerRequest(name="BasicBananas", tagline="000", region=cass.Region.north_america)
-        )
-    )
+    asyncio.run(_main())
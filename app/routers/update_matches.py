@@ -1,21 +1,50 @@
+import argparse
 import asyncio
+import dataclasses
+import datetime
 import logging
-import threading
+import math
 import time
+from typing import Any
 
 import cassiopeia as cass
 import fastapi
-from datapipelines import common as dp_common
-from psycopg import errors
-from psycopg.types import json
+import psycopg as pg
 
-from app import async_utils, db, encode, model, notifiarr, settings
+from app import db, metrics, model, notifiarr, riot_api, settings
+from app.routers import live
 
 router = fastapi.APIRouter()
 
 logger = logging.getLogger(__name__)
 
-_LOCK = threading.Lock()
+_UPDATER_LOCK_NAME = "update_matches"
+
+_DEFAULT_WORKERS = 8
+
+_DEFAULT_MAX_MATCH_ID_PAGES = 10
+
+_DEFAULT_MAX_CHECK_INTERVAL_SECONDS = 6 * 60 * 60
+
+_DEFAULT_API_BUDGET = 1000
+
+_DEFAULT_INGEST_BATCH_SIZE = 16
+
+_DEFAULT_INGEST_LEASE_SECONDS = 600
+
+_DEFAULT_INGEST_POLL_SECONDS = 5
+
+_MAX_INGEST_ATTEMPTS = 5
+
+# Riot filters match history by creation time while stored matches have their start time, so ask for slightly older
+# matches than the newest stored one
+_START_TIME_OVERLAP = datetime.timedelta(hours=1)
+
+# Summoners who started a match this recently are likely to still be playing
+_RECENTLY_ACTIVE = datetime.timedelta(hours=1)
+
+# Time constant of the moving average of each summoner's matches per day
+_MATCH_RATE_WINDOW = datetime.timedelta(days=7)
 
 
 def prune_match_data(match_data):
@@ -25,73 +54,469 @@ def prune_match_data(match_data):
             del team["participants"]
 
 
-async def _update_matches_locked():
-    loop = asyncio.get_running_loop()
-    async with await db.async_connect() as conn:
-        async for row in await conn.execute(
-            "SELECT id, summoner_data, last_updated_match_id, account_data FROM tracked_summoners"
-        ):
-            id = row["id"]
-            puuid = row["summoner_data"]["puuid"]
-            region = row["summoner_data"]["region"]
-            last_updated_match_id = row["last_updated_match_id"]
-            summoner = cass.Summoner(puuid=puuid, region=region)
-            latest_match_id = None
-            matches_stored = 0
-
-            async for match in async_utils.iterate_blocking(summoner.match_history):
-                if str(match.id) == last_updated_match_id:
-                    break
-                if latest_match_id is None:
-                    latest_match_id = match.id
-
-                try:
-                    await loop.run_in_executor(None, match.load)
-                except dp_common.NotFoundError:
-                    logger.warning(f"Could not retrieve data for {match}")
-                    continue
-
-                try:
-                    match_data = match.to_dict()
-                    prune_match_data(match_data)
-                    await conn.execute(
-                        "INSERT INTO matches(match_data) VALUES (%s)",
-                        (json.Jsonb(encode.json_ready(match_data)),),
-                    )
-                    matches_stored += 1
-                except errors.UniqueViolation:
-                    logger.debug(f"Tried to insert duplicate {match}.")
-                    continue
-
-            if latest_match_id is not None:
-                logger.info(
-                    f"Updated {row["account_data"]["name"]}#{row["account_data"]["tagline"]} and stored {matches_stored} new match{"es" if matches_stored != 1 else ""}"
+@dataclasses.dataclass
+class _SummonerProgress:
+    id: int
+    riot_id: str
+    puuid: str
+    last_updated_match_id: str | None
+    latest_match_id: str | None = None
+    # (platform, match id) of each new match, newest first
+    new_matches: list[tuple[str, str]] = dataclasses.field(default_factory=list)
+    # Set if the history or one of the new matches couldn't be fetched, in which case the summoner is retried later
+    error: Exception | None = None
+
+
+def _match_key(riot_match_id: str) -> tuple[str, str]:
+    # "NA1_1234" -> ("NA1", "1234")
+    platform, match_id = riot_match_id.split("_")
+    return (platform, match_id)
+
+
+def _worker_count() -> int:
+    # Bounds how many Riot API requests are in flight at once. The client's rate limiters are shared so extra workers
+    # wait on them rather than exceeding the limits.
+    return settings.get_dict()["updater"].get("workers", _DEFAULT_WORKERS)
+
+
+def _max_match_id_pages() -> int:
+    return settings.get_dict()["updater"].get("max_match_id_pages", _DEFAULT_MAX_MATCH_ID_PAGES)
+
+
+def _interval_seconds() -> int | float:
+    return settings.get_dict()["updater"]["interval_seconds"]
+
+
+def _max_check_interval_seconds() -> int | float:
+    return settings.get_dict()["updater"].get("max_check_interval_seconds", _DEFAULT_MAX_CHECK_INTERVAL_SECONDS)
+
+
+def _api_budget() -> int:
+    return settings.get_dict()["updater"].get("api_budget", _DEFAULT_API_BUDGET)
+
+
+def _ingest_batch_size() -> int:
+    return settings.get_dict()["updater"].get("ingest_batch_size", _DEFAULT_INGEST_BATCH_SIZE)
+
+
+def _ingest_lease_seconds() -> int | float:
+    return settings.get_dict()["updater"].get("ingest_lease_seconds", _DEFAULT_INGEST_LEASE_SECONDS)
+
+
+def _estimated_api_calls(row: dict[str, Any], now: datetime.datetime) -> float:
+    # One match history page plus a match load for each match the summoner has likely played since the last check
+    if row["last_checked_at"] is None:
+        return 1 + riot_api.MATCH_IDS_PAGE_SIZE
+    elapsed_days = (now - row["last_checked_at"]) / datetime.timedelta(days=1)
+    return 1 + row["matches_per_day"] * elapsed_days
+
+
+def _available_budget(row: dict[str, Any], now: datetime.datetime) -> float:
+    # Refills the budget left after the last scheduling pass by the configured budget per interval, whichever worker
+    # ran that pass, so that workers scheduling at different times don't each spend a full budget
+    budget = _api_budget()
+    if row["refilled_at"] is None:
+        return budget
+    elapsed_intervals = (now - row["refilled_at"]) / datetime.timedelta(seconds=_interval_seconds())
+    return min(budget, row["available"] + budget * elapsed_intervals)
+
+
+def _within_budget(rows: list[dict[str, Any]], now: datetime.datetime, budget: float) -> list[dict[str, Any]]:
+    # Rows are in priority order. Summoners left out stay due, so they are first in line next cycle.
+    if budget <= 0:
+        return []
+    selected = []
+    for row in rows:
+        cost = _estimated_api_calls(row, now)
+        if selected and cost > budget:
+            break
+        budget -= cost
+        selected.append(row)
+    return selected
+
+
+def _next_check(
+    row: dict[str, Any], new_matches: int, newest_match_start_time: datetime.datetime | None, now: datetime.datetime
+) -> tuple[float, int, datetime.datetime]:
+    # Returns the summoner's updated (matches per day, idle checks, next check time)
+    matches_per_day = row["matches_per_day"]
+    if row["last_checked_at"] is not None:
+        elapsed = now - row["last_checked_at"]
+        weight = 1 - math.exp(-(elapsed / _MATCH_RATE_WINDOW))
+        matches_per_day += weight * (new_matches / (elapsed / datetime.timedelta(days=1)) - matches_per_day)
+
+    idle_checks = 0 if new_matches else row["idle_checks"] + 1
+    if newest_match_start_time is not None and now - newest_match_start_time < _RECENTLY_ACTIVE:
+        idle_checks = 0
+
+    # Back off exponentially while a summoner isn't playing, but not past half the usual gap between their matches
+    delay_seconds = min(_interval_seconds() * 2**idle_checks, _max_check_interval_seconds())
+    if matches_per_day > 0:
+        delay_seconds = min(delay_seconds, max(_interval_seconds(), 86400 / matches_per_day / 2))
+    return matches_per_day, idle_checks, now + datetime.timedelta(seconds=delay_seconds)
+
+
+def _newer_matches(row: dict[str, Any], progress: _SummonerProgress) -> list[tuple[str, str]]:
+    # The history entries which are newer than the summoner's cursor, or their newest stored match without one, however
+    # they came to be stored. Pages can also reach back past it, through the start time overlap or a page of matches
+    # which are all stored already. Riot match ids increase over time.
+    since = row["last_updated_match_id"] or row["newest_stored_match_id"]
+    if since is None:
+        return progress.new_matches
+    return [match_key for match_key in progress.new_matches if int(match_key[1]) > int(since)]
+
+
+async def _fetch_new_matches(row: dict[str, Any], semaphore: asyncio.Semaphore) -> _SummonerProgress:
+    progress = _SummonerProgress(
+        id=row["id"],
+        riot_id=f"{row["account_data"]["name"]}#{row["account_data"]["tagline"]}",
+        puuid=row["summoner_data"]["puuid"],
+        last_updated_match_id=row["last_updated_match_id"],
+    )
+    try:
+        await _page_match_history(row, progress, semaphore)
+    except riot_api.RiotApiError as e:
+        logger.warning(f"Could not fetch match history for {progress.riot_id}: {e}")
+        progress.error = e
+    return progress
+
+
+async def _page_match_history(row: dict[str, Any], progress: _SummonerProgress, semaphore: asyncio.Semaphore):
+    region = cass.Region(row["summoner_data"]["region"])
+    start_time = None
+    if row["newest_match_start_time"] is not None:
+        start_time = row["newest_match_start_time"] - _START_TIME_OVERLAP
+
+    # Page through the history until reaching the cursor or a page of matches which are all stored already. The cursor
+    # alone isn't enough since its match can disappear from the history (e.g. remakes), and the page limit keeps a
+    # stale cursor from turning into a full history refetch.
+    max_pages = _max_match_id_pages()
+    async with semaphore:
+        for page in range(max_pages):
+            with metrics.UPDATER_STAGE_SECONDS.labels("history_fetch").time():
+                riot_match_ids = await riot_api.client().get_match_ids(
+                    progress.puuid, region, start=page * riot_api.MATCH_IDS_PAGE_SIZE, start_time=start_time
                 )
-                await conn.execute(
-                    "UPDATE tracked_summoners SET last_updated_match_id = %s WHERE id = %s",
-                    (latest_match_id, id),
+            match_keys = [_match_key(riot_match_id) for riot_match_id in riot_match_ids]
+            async with db.async_pooled_connection() as conn:
+                stored_keys = await db.find_stored_matches(conn, match_keys)
+
+            for match_key in match_keys:
+                if match_key[1] == progress.last_updated_match_id:
+                    return
+                if progress.latest_match_id is None:
+                    progress.latest_match_id = match_key[1]
+                progress.new_matches.append(match_key)
+
+            if len(match_keys) < riot_api.MATCH_IDS_PAGE_SIZE or len(stored_keys) == len(match_keys):
+                return
+
+    logger.warning(f"Stopped fetching match history for {progress.riot_id} after {max_pages} pages")
+
+
+async def _load_match(
+    match_key: tuple[str, str],
+    semaphore: asyncio.Semaphore,
+    writer: db.AsyncMatchWriter,
+    failed_matches: set[tuple[str, str]],
+):
+    platform, match_id = match_key
+    async with semaphore:
+        try:
+            with metrics.UPDATER_STAGE_SECONDS.labels("match_load").time():
+                match_data = await riot_api.client().get_match(cass.Platform(platform), match_id)
+        except riot_api.NotFoundError:
+            logger.warning(f"Could not retrieve data for {platform}_{match_id}")
+            return
+        except riot_api.RiotApiError as e:
+            logger.warning(f"Could not load {platform}_{match_id}: {e}")
+            failed_matches.add(match_key)
+            return
+
+    # Enums, timestamps and durations are converted as the match is serialized by the JSONB dumper
+    prune_match_data(match_data)
+    await writer.add(match_data)
+
+
+async def _enqueue_due_summoners(conn: pg.AsyncConnection):
+    budget_row = await (
+        await conn.execute("SELECT available, refilled_at, NOW() AS now FROM updater_budget")
+    ).fetchone()
+    now = budget_row["now"]
+    budget = _available_budget(budget_row, now)
+
+    cursor = await conn.execute(
+        """
+            SELECT id, matches_per_day, last_checked_at
+            FROM tracked_summoners
+            WHERE next_check_at <= NOW()
+                AND NOT EXISTS (SELECT 1 FROM ingest_jobs WHERE ingest_jobs.summoner_id = tracked_summoners.id)
+            ORDER BY next_check_at, matches_per_day DESC;
+        """
+    )
+    due_rows = await cursor.fetchall()
+
+    rows = _within_budget(due_rows, now, budget)
+    if len(rows) < len(due_rows):
+        logger.info(f"Deferring {len(due_rows) - len(rows)} due summoners to stay within the API budget")
+
+    # An expensive summoner can overdraw the budget, which later passes then make up for
+    spent = sum(_estimated_api_calls(row, now) for row in rows)
+    async with conn.transaction():
+        await conn.execute(
+            "INSERT INTO ingest_jobs (summoner_id) SELECT UNNEST(%s::bigint[]) ON CONFLICT DO NOTHING",
+            ([row["id"] for row in rows],),
+        )
+        await conn.execute("UPDATE updater_budget SET available = %s, refilled_at = %s", (budget - spent, now))
+
+
+async def _claim_jobs(conn: pg.AsyncConnection) -> list[dict[str, Any]]:
+    cursor = await conn.execute(
+        """
+            WITH claimable AS (
+                SELECT summoner_id
+                FROM ingest_jobs
+                WHERE due_at <= NOW()
+                    AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+                ORDER BY due_at
+                LIMIT %(batch_size)s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE ingest_jobs
+            SET
+                attempts = ingest_jobs.attempts + 1,
+                lease_expires_at = NOW() + MAKE_INTERVAL(secs => %(lease_seconds)s)
+            FROM claimable
+            WHERE ingest_jobs.summoner_id = claimable.summoner_id
+            RETURNING ingest_jobs.summoner_id, ingest_jobs.attempts, ingest_jobs.lease_expires_at;
+        """,
+        {"batch_size": _ingest_batch_size(), "lease_seconds": _ingest_lease_seconds()},
+    )
+    return await cursor.fetchall()
+
+
+async def _renew_leases(conn: pg.AsyncConnection, jobs: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    # Extends the leases which are still held, returning those jobs with their new lease. A job whose lease ran out may
+    # have been claimed by another worker, which then owns it.
+    cursor = await conn.execute(
+        """
+            UPDATE ingest_jobs
+            SET lease_expires_at = NOW() + MAKE_INTERVAL(secs => %(lease_seconds)s)
+            FROM UNNEST(%(summoner_ids)s::bigint[], %(lease_expires_ats)s::timestamptz[]) AS held(summoner_id, lease_expires_at)
+            WHERE ingest_jobs.summoner_id = held.summoner_id
+                AND ingest_jobs.lease_expires_at = held.lease_expires_at
+                AND held.lease_expires_at > NOW()
+            RETURNING ingest_jobs.summoner_id, ingest_jobs.attempts, ingest_jobs.lease_expires_at;
+        """,
+        {
+            "lease_seconds": _ingest_lease_seconds(),
+            "summoner_ids": [job["summoner_id"] for job in jobs],
+            "lease_expires_ats": [job["lease_expires_at"] for job in jobs],
+        },
+    )
+    held_jobs = await cursor.fetchall()
+    if len(held_jobs) < len(jobs):
+        held_ids = {job["summoner_id"] for job in held_jobs}
+        lost_ids = [job["summoner_id"] for job in jobs if job["summoner_id"] not in held_ids]
+        logger.warning(f"Lost the ingest leases of summoners {lost_ids} before finishing them")
+    return held_jobs
+
+
+async def _release_failed_jobs(conn: pg.AsyncConnection, jobs: list[dict[str, Any]]):
+    # Retry with exponential backoff. Summoners which keep failing are left until the longest regular check interval
+    # has passed, since they would be queued again right away if they were still due.
+    exhausted_ids = [job["summoner_id"] for job in jobs if job["attempts"] >= _MAX_INGEST_ATTEMPTS]
+    if exhausted_ids:
+        logger.warning(f"Giving up on ingesting summoners {exhausted_ids} after {_MAX_INGEST_ATTEMPTS} attempts")
+        await conn.execute("DELETE FROM ingest_jobs WHERE summoner_id = ANY(%s)", (exhausted_ids,))
+        await conn.execute(
+            """
+                UPDATE tracked_summoners
+                SET next_check_at = NOW() + MAKE_INTERVAL(secs => %s)
+                WHERE id = ANY(%s);
+            """,
+            (_max_check_interval_seconds(), exhausted_ids),
+        )
+    await conn.execute(
+        """
+            UPDATE ingest_jobs
+            SET
+                lease_expires_at = NULL,
+                due_at = NOW() + MAKE_INTERVAL(secs => %s * 2 ^ (attempts - 1))
+            WHERE summoner_id = ANY(%s);
+        """,
+        (_interval_seconds(), [job["summoner_id"] for job in jobs]),
+    )
+
+
+async def _ingest(conn: pg.AsyncConnection, jobs: list[dict[str, Any]]) -> tuple[int, int]:
+    # Returns how many of the jobs were done and how many failed
+    cursor = await conn.execute(
+        """
+            SELECT
+                id,
+                summoner_data,
+                last_updated_match_id,
+                account_data,
+                matches_per_day,
+                idle_checks,
+                last_checked_at,
+                (
+                    SELECT MAX(start_time)
+                    FROM match_participants
+                    WHERE match_participants.puuid = tracked_summoners.summoner_data ->> 'puuid'
+                ) AS newest_match_start_time,
+                (
+                    SELECT matches.match_id
+                    FROM match_participants
+                    JOIN matches ON matches.id = match_participants.match_id
+                    WHERE match_participants.puuid = tracked_summoners.summoner_data ->> 'puuid'
+                    ORDER BY match_participants.start_time DESC
+                    LIMIT 1
+                ) AS newest_stored_match_id
+            FROM tracked_summoners
+            WHERE id = ANY(%s);
+        """,
+        ([job["summoner_id"] for job in jobs],),
+    )
+    rows = await cursor.fetchall()
+    now = datetime.datetime.now(datetime.UTC)
+
+    # Riot API errors only fail the summoners they affect. Anything else fails the batch, and the task groups cancel
+    # the remaining requests first so that none of them outlive the batch's connection.
+    semaphore = asyncio.Semaphore(_worker_count())
+    async with asyncio.TaskGroup() as task_group:
+        fetch_tasks = [task_group.create_task(_fetch_new_matches(row, semaphore)) for row in rows]
+    progresses = [task.result() for task in fetch_tasks]
+    jobs = await _renew_leases(conn, jobs)
+
+    # Tracked summoners often play together, so only fetch each match once per batch and skip matches which were
+    # already stored through another summoner in an earlier cycle.
+    unique_matches: set[tuple[str, str]] = set()
+    for progress in progresses:
+        unique_matches.update(progress.new_matches)
+
+    already_stored_keys = await db.find_stored_matches(conn, unique_matches)
+    missing_matches = unique_matches - already_stored_keys
+
+    failed_matches: set[tuple[str, str]] = set()
+    async with db.AsyncMatchWriter(conn) as writer:
+        async with asyncio.TaskGroup() as task_group:
+            for match_key in missing_matches:
+                task_group.create_task(_load_match(match_key, semaphore, writer, failed_matches))
+
+    cursor = await conn.execute(
+        """
+            SELECT puuid, MAX(start_time) AS start_time
+            FROM match_participants
+            WHERE puuid = ANY(%s)
+            GROUP BY puuid;
+        """,
+        ([progress.puuid for progress in progresses],),
+    )
+    newest_match_start_times = {row["puuid"]: row["start_time"] async for row in cursor}
+
+    # Loads are only saved on matches a summoner's cursor walk would have loaded, not the ones which pages reach back to
+    cursor_loads = [match_key for row, progress in zip(rows, progresses) for match_key in _newer_matches(row, progress)]
+    cursor_keys = set(cursor_loads)
+    shared_loads = len(cursor_loads) - len(cursor_keys)
+    stored_loads = len(cursor_keys & already_stored_keys)
+    metrics.MATCHES_STORED.inc(writer.inserted)
+    metrics.MATCHES_SKIPPED_DUPLICATES.inc(writer.skipped)
+    metrics.MATCH_LOADS_SAVED.inc(shared_loads + stored_loads)
+    logger.info(
+        f"Ingest batch stored {writer.inserted} new matches (skipped {writer.skipped} duplicates) and saved "
+        f"{shared_loads + stored_loads} match API calls ({shared_loads} shared between tracked summoners, "
+        f"{stored_loads} already stored)"
+    )
+
+    # The leases are checked and the results recorded in one transaction so that another worker can't claim the jobs
+    # in between. It comes last, so nothing has been recorded if this raises.
+    async with conn.transaction():
+        held_jobs = {job["summoner_id"]: job for job in await _renew_leases(conn, jobs)}
+        done_ids = []
+        failed_jobs = []
+        for row, progress in zip(rows, progresses):
+            if progress.id not in held_jobs:
+                continue
+            if progress.error is None and any(match_key in failed_matches for match_key in progress.new_matches):
+                progress.error = riot_api.RiotApiError("Some new matches could not be loaded")
+            if progress.error is not None:
+                failed_jobs.append(held_jobs[progress.id])
+                continue
+
+            # Matches count towards how often they play even if another summoner's check stored them first
+            new_matches = len(_newer_matches(row, progress))
+            if progress.latest_match_id is not None:
+                logger.info(
+                    f"Updated {progress.riot_id} with {new_matches} new match{"es" if new_matches != 1 else ""}"
                 )
 
+            matches_per_day, idle_checks, next_check_at = _next_check(
+                row, new_matches, newest_match_start_times.get(progress.puuid), now
+            )
+            await conn.execute(
+                """
+                    UPDATE tracked_summoners
+                    SET
+                        last_updated_match_id = COALESCE(%s, last_updated_match_id),
+                        matches_per_day = %s,
+                        idle_checks = %s,
+                        last_checked_at = %s,
+                        next_check_at = %s
+                    WHERE id = %s;
+                """,
+                (progress.latest_match_id, matches_per_day, idle_checks, now, next_check_at, progress.id),
+            )
+            done_ids.append(progress.id)
+
+        await conn.execute("DELETE FROM ingest_jobs WHERE summoner_id = ANY(%s)", (done_ids,))
+        if failed_jobs:
+            await _release_failed_jobs(conn, failed_jobs)
+    return len(done_ids), len(failed_jobs)
+
 
 async def update_matches():
-    if not _LOCK.acquire(blocking=False):
-        return
+    # Only one worker across the deployment schedules checks at a time so that passes don't spend the same budget. The
+    # lock is released as soon as its holder's connection goes away, so another worker takes over if the holder dies.
+    async with db.try_advisory_lock(_UPDATER_LOCK_NAME) as conn:
+        if conn is None:
+            logger.info("Skipping scheduling since another worker is running it")
+            return
 
-    try:
-        await _update_matches_locked()
-    finally:
-        _LOCK.release()
+        with metrics.UPDATER_STAGE_SECONDS.labels("schedule").time():
+            await _enqueue_due_summoners(conn)
+
+
+async def ingest_next_batch() -> int:
+    # Claims and checks a batch of queued summoners, returning how many jobs were claimed
+    async with db.async_pooled_connection() as conn:
+        jobs = await _claim_jobs(conn)
+        if not jobs:
+            return 0
+
+        try:
+            with metrics.INGEST_BATCH_SECONDS.time():
+                done, failed = await _ingest(conn, jobs)
+        except Exception:
+            # _ingest records its results last, so none of the jobs have been recorded
+            metrics.INGEST_JOBS.labels("failed").inc(len(jobs))
+            await _release_failed_jobs(conn, jobs)
+            raise
+        metrics.INGEST_JOBS.labels("done").inc(done)
+        metrics.INGEST_JOBS.labels("failed").inc(failed)
+        return len(jobs)
 
 
 @router.post("/v1/update_matches")
-async def update_matches_handler(_: model.Empty, background_tasks: fastapi.BackgroundTasks) -> model.Empty:
-    background_tasks.add_task(update_matches)
+async def update_matches_handler(_: model.Empty) -> model.Empty:
+    await update_matches()
     return model.Empty()
 
 
 async def update_matches_loop(interval_seconds: int | float | None = None):
     if interval_seconds is None:
-        interval_seconds = settings.get_dict()["updater"]["interval_seconds"]
+        interval_seconds = _interval_seconds()
 
     start_time = 0
     end_time = 0
@@ -102,22 +527,59 @@ async def update_matches_loop(interval_seconds: int | float | None = None):
                 await asyncio.sleep(interval_seconds - (end_time - start_time))
             start_time = time.monotonic()
             await update_matches()
+            # Picks up the matches ingested since the last cycle, by whichever worker ingested them
+            await live.refresh_matchups()
             end_time = time.monotonic()
         except asyncio.CancelledError:
             return
         except Exception as e:
             end_time = time.monotonic()
+            _notify_error("Updater loop", e)
 
-            logger.exception("Updater loop encountered error:", exc_info=e)
-            notifiarr.send_notification(
-                event="LeagueStats",
-                title="Server Error",
-                body=str(e),
-                color="FF0000",
-                **settings.notifiarr_settings(),
-            )
+
+async def ingest_loop(poll_seconds: int | float | None = None):
+    if poll_seconds is None:
+        poll_seconds = settings.get_dict()["updater"].get("ingest_poll_seconds", _DEFAULT_INGEST_POLL_SECONDS)
+
+    logger.info("Starting ingest worker")
+    while True:
+        try:
+            if await ingest_next_batch() == 0:
+                await asyncio.sleep(poll_seconds)
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            _notify_error("Ingest worker", e)
+            await asyncio.sleep(poll_seconds)
+
+
+def _notify_error(source: str, e: Exception):
+    logger.exception(f"{source} encountered error:", exc_info=e)
+    notifiarr.send_notification(
+        event="LeagueStats",
+        title="Server Error",
+        body=str(e),
+        color="FF0000",
+        **settings.notifiarr_settings(),
+    )
+
+
+async def _main(worker: bool):
+    if worker:
+        await ingest_loop()
+        return
+
+    await update_matches()
+    while await ingest_next_batch():
+        pass
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check tracked summoners for new matches.")
+    parser.add_argument(
+        "--worker", action="store_true", help="Keep consuming queued ingest jobs instead of running a single cycle."
+    )
+    args = parser.parse_args()
+
     settings.apply_global_settings()
-    asyncio.run(update_matches())
+    asyncio.run(_main(args.worker))
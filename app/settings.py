@@ -23,6 +23,10 @@ def riot_api_key() -> str:
     return get_dict()["pipeline"]["RiotAPI"]["api_key"]
 
 
+def riot_api_settings() -> dict[str, Any]:
+    return get_dict()["pipeline"]["RiotAPI"]
+
+
 def default_region() -> cass.Region:
     return cass.Region(get_dict()["global"]["default_region"])
 
@@ -31,6 +35,10 @@ def sql_conn_settings() -> dict[str, Any]:
     return get_dict()["sql"]["connection"]
 
 
+def sql_pool_settings() -> dict[str, Any]:
+    return get_dict()["sql"].get("pool", {})
+
+
 def notifiarr_settings() -> dict[str, Any]:
     return get_dict()["notifiarr"]
 